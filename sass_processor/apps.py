@@ -1,31 +1,104 @@
 import re
 import os
+import json
+import threading
+from fnmatch import fnmatch
 from django.apps import apps, AppConfig
 from django.conf import settings
 from django.contrib.staticfiles.finders import AppDirectoriesFinder
 
 
 APPS_INCLUDE_DIRS = []
+_apps_include_dirs_lock = threading.Lock()
+_apps_include_dirs_found = False
+
+
+def get_apps_include_dirs():
+    """
+    Return the static folders of all installed apps containing SASS partials. They are looked up
+    on first invocation only, and then kept in `APPS_INCLUDE_DIRS`.
+    """
+    global _apps_include_dirs_found
+
+    if not _apps_include_dirs_found:
+        with _apps_include_dirs_lock:
+            if not _apps_include_dirs_found:
+                APPS_INCLUDE_DIRS[:] = SassProcessorConfig.find_include_dirs()
+                _apps_include_dirs_found = True
+    return APPS_INCLUDE_DIRS
+
 
 class SassProcessorConfig(AppConfig):
     name = 'sass_processor'
     verbose_name = "Sass Processor"
     auto_include = getattr(settings, 'SASS_PROCESSOR_AUTO_INCLUDE', True)
     _pattern = re.compile(getattr(settings, 'SASS_PROCESSOR_INCLUDE_FILE_PATTERN', r'^_.+\.(scss|sass)$'))
+    _ignore_patterns = getattr(settings, 'SASS_PROCESSOR_AUTO_INCLUDE_IGNORE', ['node_modules', '.*'])
+    _cache_file = getattr(settings, 'SASS_PROCESSOR_AUTO_INCLUDE_CACHE', None)
 
     def ready(self):
-        if self.auto_include:
-            app_configs = apps.get_app_configs()
-            for app_config in app_configs:
-                static_dir = os.path.join(app_config.path, AppDirectoriesFinder.source_dir)
-                if os.path.isdir(static_dir):
-                    self.traverse_tree(static_dir)
+        from sass_processor.processor import SassProcessor
+
+        if SassProcessor.uses_manifest():
+            SassProcessor.manifest.load()
+
+    @classmethod
+    def find_include_dirs(cls):
+        """
+        Return the static folders of all installed apps containing at least one SASS partial.
+        If `SASS_PROCESSOR_AUTO_INCLUDE_CACHE` is set, the outcome of traversing each static folder
+        is kept in that file, together with the modification times of the traversed folders.
+        As long as none of them changed, that folder is not traversed again.
+        """
+        if not cls.auto_include:
+            return []
+        cache = cls.read_cache()
+        include_dirs, cache_changed = [], False
+        for app_config in apps.get_app_configs():
+            static_dir = os.path.join(app_config.path, AppDirectoriesFinder.source_dir)
+            if not os.path.isdir(static_dir):
+                continue
+            entry = cache.get(static_dir)
+            if entry is None or not cls.is_unchanged(entry['dirs']):
+                entry = cache[static_dir] = cls.traverse_tree(static_dir)
+                cache_changed = True
+            if entry['match']:
+                include_dirs.append(static_dir)
+        if cache_changed and cls._cache_file:
+            from sass_processor.utils import write_json
+
+            write_json(str(cls._cache_file), cache)
+        return include_dirs
+
+    @classmethod
+    def read_cache(cls):
+        if not cls._cache_file:
+            return {}
+        try:
+            with open(str(cls._cache_file), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def is_unchanged(dirs):
+        try:
+            return all(os.stat(dirname).st_mtime == mtime for dirname, mtime in dirs.items())
+        except OSError:
+            return False
 
     @classmethod
     def traverse_tree(cls, static_dir):
-        """traverse the static folders an look for at least one file ending in .scss/.sass"""
+        """
+        traverse the static folders an look for at least one file ending in .scss/.sass, skipping
+        folders matching one of the patterns in `SASS_PROCESSOR_AUTO_INCLUDE_IGNORE`. Return if
+        such a file has been found, together with the modification times of the traversed folders.
+        """
+        dirs_mtimes = {}
         for root, dirs, files in os.walk(static_dir):
+            dirs_mtimes[root] = os.stat(root).st_mtime
+            dirs[:] = [d for d in dirs if not any(fnmatch(d, pattern) for pattern in cls._ignore_patterns)]
             for filename in files:
                 if cls._pattern.match(filename):
-                    APPS_INCLUDE_DIRS.append(static_dir)
-                    return
+                    return {'match': True, 'dirs': dirs_mtimes}
+        return {'match': False, 'dirs': dirs_mtimes}
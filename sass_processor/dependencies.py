@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from sass_processor.utils import write_json
+
+
+def content_digest(content):
+    """Return the hex digest of the given bytes."""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def file_digest(filename):
+    """Return the hex digest of the content of the given file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_fingerprint(source_digests, options):
+    """
+    Return a fingerprint over the digests of all files, given as mapping of filename to digest,
+    and the compiler options.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for srcfilename in sorted(source_digests):
+        digest.update(srcfilename.encode())
+        digest.update(source_digests[srcfilename].encode())
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DependencyIndex:
+    """
+    A local JSON file mapping each compiled SASS/SCSS file onto the CSS file it has been compiled
+    into and the files it depends on, together with their modification times and sizes at compile
+    time. The index is read only once and then kept in memory, so that freshness checks neither
+    have to parse the sourcemap nor to access the storage.
+
+    With `use_hashes`, the digest of each dependency is recorded as well. A dependency whose
+    modification time changed, then still is considered unchanged, if its content did not change.
+    Files whose modification time and size did not change, are never rehashed.
+    """
+    def __init__(self, path, use_hashes=False):
+        self.path = str(path)
+        self.use_hashes = use_hashes
+        self._entries = None
+        self._dependents = None, {}
+        self._pending = None
+        self._file_digests = None
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._entries = self._read()
+        return self._entries
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, filename):
+        return self.entries.get(filename)
+
+    def get_dependencies(self, filename):
+        """
+        Return the list of files the given SASS file depends on, or None if there is no entry for
+        it, or if at least one of them has been modified since it was compiled.
+        """
+        entry = self.get(filename)
+        if entry is None:
+            return None
+        for srcfilename, record in entry['sources'].items():
+            try:
+                if self.get_digest(srcfilename, record) is None:
+                    return None
+            except OSError:
+                return None
+        return list(entry['sources'])
+
+    def get_digest(self, srcfilename, record):
+        """
+        Compare a dependency with its record `[mtime, size, digest]` taken at compile time. Return
+        its digest, or an empty string if digests are not used, if the file is unchanged. Otherwise
+        return None. Raises `OSError` if the file is missing.
+        """
+        stat = os.stat(srcfilename)
+        if [stat.st_mtime, stat.st_size] == record[:2]:
+            return record[2] if len(record) > 2 else ''
+        if self.use_hashes and len(record) > 2 and stat.st_size == record[1]:
+            if self.get_file_digest(srcfilename) == record[2]:
+                # remember the new modification time, so that this file is not rehashed again
+                record[0] = stat.st_mtime
+                return record[2]
+
+    def get_dependents(self, filename):
+        """
+        Return the sorted list of compiled SASS files depending on the given file, such as all files
+        importing a partial. A compiled SASS file also depends on itself.
+        """
+        return sorted(self.get_reverse_index().get(os.path.abspath(filename), ()))
+
+    def get_reverse_index(self):
+        """
+        Return a mapping of each recorded dependency onto the set of compiled SASS files depending
+        on it. It is rebuilt whenever the index changed.
+        """
+        entries = self.entries
+        with self._lock:
+            if self._dependents[0] is not entries:
+                dependents = {}
+                for filename, entry in entries.items():
+                    for srcfilename in entry['sources']:
+                        dependents.setdefault(srcfilename, set()).add(filename)
+                self._dependents = entries, dependents
+            return self._dependents[1]
+
+    def get_source_digests(self, filename):
+        """
+        Return a mapping of each file the given SASS file depends on, onto the digest of its current
+        content, or None if there is no entry for it or one of these files is missing.
+        Only files whose modification time or size changed since they were recorded, are rehashed.
+        """
+        entry = self.get(filename)
+        if entry is None:
+            return None
+        source_digests = {}
+        try:
+            for srcfilename, record in entry['sources'].items():
+                digest = self.get_digest(srcfilename, record) or self.get_file_digest(srcfilename)
+                source_digests[srcfilename] = digest
+        except OSError:
+            return None
+        return source_digests
+
+    def get_file_digest(self, filename):
+        """
+        Return the digest of the content of the given file. Inside `batch()`, each file is hashed
+        only once.
+        """
+        if self._file_digests is None:
+            return file_digest(filename)
+        if filename not in self._file_digests:
+            self._file_digests[filename] = file_digest(filename)
+        return self._file_digests[filename]
+
+    def update(self, filename, css_filename, dependencies, source_digests=None, **extra):
+        """
+        Record the dependencies of a freshly compiled SASS file and persist the index.
+        Entries written by other processes in the meantime are merged in.
+        """
+        sources = {}
+        for srcfilename in dependencies:
+            stat = os.stat(srcfilename)
+            sources[srcfilename] = record = [stat.st_mtime, stat.st_size]
+            if self.use_hashes:
+                record.append((source_digests or {}).get(srcfilename) or self.get_file_digest(srcfilename))
+        entry = {'css': css_filename, 'sources': sources}
+        entry.update(extra)
+        entries = self.entries
+        with self._lock:
+            if self._pending is not None:
+                # persisted when leaving `batch()`
+                self._pending[filename] = entry
+                self._entries = entries = dict(entries)
+                entries[filename] = entry
+                return
+            entries = self._read()
+            entries[filename] = entry
+            write_json(self.path, entries)
+            self._entries = entries
+
+    def discard(self, filename):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.pop(filename, None)
+            entries = self._read()
+            if entries.pop(filename, None) is not None:
+                write_json(self.path, entries)
+            if self._pending:
+                entries.update(self._pending)
+            self._entries = entries
+
+    @contextmanager
+    def batch(self):
+        """
+        Within this context, updates are kept in memory and persisted at once when leaving it, and
+        the content of each file is hashed only once, assuming it does not change meanwhile.
+        """
+        with self._lock:
+            self._pending, self._file_digests = {}, {}
+        try:
+            yield self
+        finally:
+            with self._lock:
+                pending, self._pending, self._file_digests = self._pending, None, None
+                if pending:
+                    entries = self._read()
+                    entries.update(pending)
+                    write_json(self.path, entries)
+                    self._entries = entries
+
+    def clear(self):
+        """Forget the in-memory copy, so that the index is reread on next access."""
+        with self._lock:
+            self._entries = None
@@ -1,15 +1,32 @@
 from jinja2 import nodes
 from jinja2.ext import Extension
-from sass_processor.processor import SassProcessor
+from sass_processor.processor import SassProcessor, sass_processor
 
 
 class SassSrc(Extension):
     tags = set(['sass_src'])
 
+    def __init__(self, environment):
+        super().__init__(environment)
+        self.urls = {}
+
     def parse(self, parser):
         lineno = next(parser.stream).lineno
         path = parser.parse_expression()
 
+        if (isinstance(path, nodes.Const) and not SassProcessor.checks_freshness()
+                and self.environment.bytecode_cache is None):
+            # a constant path has to be resolved only once per environment. This is not possible
+            # with a bytecode cache, which would keep the URL across restarts and deployments
+            try:
+                return nodes.Output(
+                    [nodes.Const(self._resolve_url(path.value))],
+                    lineno=lineno
+                )
+            except FileNotFoundError:
+                # defer the error until the template is rendered
+                pass
+
         call = self.call_method(
             '_sass_src_support', [
                 path,
@@ -21,6 +38,10 @@ class SassSrc(Extension):
             lineno=lineno
         )
 
+    def _resolve_url(self, path):
+        if path not in self.urls:
+            self.urls[path] = sass_processor(path)
+        return self.urls[path]
+
     def _sass_src_support(self, path, source_file):
-        sass_processor = SassProcessor(source_file)
-        return SassProcessor.handle_simple(sass_processor(path))
+        return sass_processor(path)
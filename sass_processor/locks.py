@@ -0,0 +1,35 @@
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def compile_lock(key, lock_dir=None):
+    """
+    Serialize the compilation of the target identified by `key`. Threads of the same process wait
+    on a lock per target. If `lock_dir` is given, processes additionally wait on an exclusive lock
+    of a file inside that directory. File locks are only available on POSIX systems.
+    """
+    with _locks_guard:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        if not lock_dir or fcntl is None:
+            yield
+            return
+        os.makedirs(lock_dir, exist_ok=True)
+        lockname = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest() + '.lock'
+        with open(os.path.join(lock_dir, lockname), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
@@ -1,15 +1,20 @@
 import os
 
 import ast
+import itertools
+import json
+import mmap
+import re
+from concurrent.futures import ProcessPoolExecutor
 from importlib import import_module
+from io import StringIO
 import sass
 from compressor.exceptions import TemplateDoesNotExist, TemplateSyntaxError
 from pathlib import Path
 
 from django.apps import apps
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand, CommandError, OutputWrapper
 from django.template import engines
 from django.template.base import Origin
 from django.template.loader import \
@@ -17,15 +22,81 @@ from django.template.loader import \
 from django.utils.encoding import force_bytes
 from django.utils.translation import gettext_lazy as _
 
-from sass_processor.apps import APPS_INCLUDE_DIRS
+from sass_processor.dependencies import DependencyIndex, compute_fingerprint, content_digest
 from sass_processor.processor import SassProcessor
-from sass_processor.storage import SassFileStorage, find_file
+from sass_processor.storage import SassFileStorage, find_file, save_file, write_file
 from sass_processor.templatetags.sass_tags import SassSrcNode
-from sass_processor.utils import get_custom_functions
+from sass_processor.utils import get_custom_functions, get_postprocessor_signatures, postprocess, write_json
 
 __all__ = ['get_template', 'Command']
 
 
+def _init_worker():
+    """
+    Set up Django in worker processes which have been spawned rather than forked.
+    """
+    from django.apps import apps
+
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def _compile_sass(compile_kwargs):
+    """
+    Compile a SASS file inside a worker process. Custom functions can not be pickled,
+    hence they are rebuilt in each worker.
+    """
+    compile_kwargs['custom_functions'] = get_custom_functions()
+    return sass.compile(**compile_kwargs)
+
+
+SASS_PROCESSOR_CALL = re.compile(rb'\bsass_processor\s*\(')
+SASS_SRC_TAG = re.compile(rb'\bsass_src\b')
+SCAN_PATTERNS = {'source': SASS_PROCESSOR_CALL, 'template': SASS_SRC_TAG}
+
+
+_scanner = None
+
+
+def _init_scanner(engine, verbosity):
+    """
+    Set up a command instance in each worker process, used to parse Python files and templates.
+    """
+    global _scanner
+    _init_worker()
+    _scanner = Command()
+    _scanner.parser = _scanner.get_parser(engine)
+    _scanner.verbosity = verbosity
+
+
+def _scan_file(kind, filename):
+    """
+    Return the SASS files referred by a Python file or template and the errors reported while
+    parsing it, so that the parent process can report them in a deterministic order.
+    """
+    stderr = StringIO()
+    _scanner.stderr = OutputWrapper(stderr)
+    references = getattr(_scanner, 'find_{}_references'.format(kind))(filename)
+    return references, stderr.getvalue()
+
+
+def file_contains(filename, pattern):
+    """
+    Cheaply check if a file matches the given bytes pattern, without decoding or parsing it.
+    Unreadable files are reported as matching, so that the caller's parser reports the error.
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            try:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return pattern.search(mm) is not None
+            except ValueError:  # empty files can not be mapped
+                return False
+    except OSError:
+        return True
+
+
 class FuncCallVisitor(ast.NodeVisitor):
 
     def __init__(self, func_name):
@@ -49,9 +120,11 @@ class Command(BaseCommand):
     def __init__(self):
         self.parser = None
         self.template_exts = getattr(settings, 'SASS_TEMPLATE_EXTS', ['.html'])
-        self.sass_output_style = getattr(settings, 'SASS_OUTPUT_STYLE',
-                                         'nested' if settings.DEBUG else 'compressed')
         self.use_storage = False
+        self.engine = 'django'
+        self.jobs = 1
+        self.scan_cache, self.scanned_files = None, {}
+        self.changed_files = None
         super().__init__()
 
     def add_arguments(self, parser):
@@ -83,6 +156,45 @@ class Command(BaseCommand):
             help=_(
                 "Set the precision for numeric computations in the SASS processor. Default: settings.SASS_PRECISION.")
         )
+        parser.add_argument(
+            '--jobs',
+            dest='jobs',
+            type=int,
+            default=1,
+            help=_("Number of SASS/SCSS files to compile in parallel. Use 0 for one job per CPU. Default: 1.")
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help=_("Skip SASS/SCSS files whose content, dependencies and compiler options did not "
+                   "change since the last run.")
+        )
+        parser.add_argument(
+            '--cache-dir',
+            dest='cache_dir',
+            default=getattr(settings, 'SASS_PROCESSOR_CACHE_DIR', '.sass-processor-cache'),
+            help=_("Directory to keep the state between runs of this command. "
+                   "Default: settings.SASS_PROCESSOR_CACHE_DIR or '.sass-processor-cache'.")
+        )
+        parser.add_argument(
+            '--list-references',
+            action='store_true',
+            dest='list_references',
+            default=False,
+            help=_("List the referred SASS/SCSS files together with the Python files and templates "
+                   "referring them, instead of compiling them.")
+        )
+
+        parser.add_argument(
+            '--changed',
+            nargs='+',
+            dest='changed',
+            metavar='FILE',
+            help=_("Only compile the SASS/SCSS files depending on one of the given files, according "
+                   "to the dependencies recorded by previous runs. Implies --incremental.")
+        )
 
     def get_loaders(self):
         template_source_loaders = []
@@ -133,36 +245,58 @@ class Command(BaseCommand):
         self.verbosity = int(options['verbosity'])
         self.delete_files = options['delete_files']
         self.use_storage = options['use_storage']
+        self.jobs = options['jobs'] if options['jobs'] > 0 else os.cpu_count() or 1
+        self.changed_files = options['changed'] and [os.path.abspath(f) for f in options['changed']]
+        self.cache_dir = options['cache_dir'] if options['incremental'] or self.changed_files else None
+        self.fingerprints = None
+        if self.cache_dir:
+            self.fingerprints = DependencyIndex(os.path.join(self.cache_dir, 'fingerprints.json'), use_hashes=True)
+        self.manifest_entries = {}
 
         engines = [e.strip() for e in options.get('engines', [])] or ['django']
         for engine in engines:
+            self.engine = engine
             self.parser = self.get_parser(engine)
             try:
                 self.sass_precision = int(options['sass_precision'] or settings.SASS_PRECISION)
             except (AttributeError, TypeError, ValueError):
                 self.sass_precision = None
+            self.profile = SassProcessor.get_compile_profile().replace(precision=self.sass_precision)
 
-            self.processed_files = []
+            self.processed_files = set()
+            self.skipped_files = []
+            self.sass_files = {}
+            self.references = {}
+            self.resolved_files = {}
+            self.load_scan_cache(engine)
 
             # find all Python files making up this project; They might invoke `sass_processor`
-            for py_source in self.find_sources():
+            for py_source, references in self.scan_files(list(self.find_sources()), 'source'):
                 if self.verbosity > 1:
                     self.stdout.write("Parsing file: {}".format(py_source))
                 elif self.verbosity == 1:
                     self.stdout.write(".", ending="")
-                try:
-                    self.parse_source(py_source)
-                except (SyntaxError, IndentationError) as exc:
-                    msg = "Syntax error encountered processing {0}: {1}\nAborting compilation."
-                    self.stderr.write(msg.format(py_source, exc))
-                    raise
+                for sass_fileurl in references:
+                    self.add_sass_file(sass_fileurl, py_source)
 
             # find all Django/Jinja2 templates making up this project; They might invoke `sass_src`
-            templates = self.find_templates()
-            for template_name in templates:
-                self.parse_template(template_name)
+            templates = sorted(self.find_templates())
+            for template_name, references in self.scan_files(templates, 'template'):
+                for sass_fileurl in references or []:
+                    self.add_sass_file(sass_fileurl, template_name)
                 if self.verbosity > 0:
                     self.stdout.write(".", ending="")
+            self.save_scan_cache()
+
+            # delete or compile the collected SASS/SCSS files
+            if options['list_references']:
+                self.list_references()
+                continue
+            if self.delete_files:
+                for sass_filename, sass_fileurl in self.sass_files.items():
+                    self.delete_file(sass_filename, sass_fileurl)
+            else:
+                self.compile_sass_files()
 
             # summarize what has been done
             if self.verbosity > 0:
@@ -173,6 +307,14 @@ class Command(BaseCommand):
                 else:
                     msg = "Successfully compiled {0} referred SASS/SCSS files."
                     self.stdout.write(msg.format(len(self.processed_files)))
+                    if self.skipped_files:
+                        msg = "Skipped {0} unchanged SASS/SCSS files."
+                        self.stdout.write(msg.format(len(self.skipped_files)))
+
+        if SassProcessor.manifest and not (self.delete_files or options['list_references']):
+            SassProcessor.manifest.write(self.manifest_entries)
+            if self.verbosity > 1:
+                self.stdout.write("Written manifest: '{0}'\n".format(SassProcessor.manifest.path))
 
     def find_sources(self):
         """
@@ -195,22 +337,135 @@ class Command(BaseCommand):
                             continue
                         yield os.path.abspath(os.path.join(root, filename))
 
+    def load_scan_cache(self, engine):
+        """
+        In incremental mode, load the SASS/SCSS files referred by each file during the previous run.
+        """
+        self.scan_cache, self.scanned_files = None, {}
+        if not self.cache_dir:
+            return
+        self.scan_cache_path = os.path.join(self.cache_dir, 'scan-{}.json'.format(engine))
+        try:
+            with open(self.scan_cache_path, 'r') as fp:
+                self.scan_cache = json.load(fp)
+        except (OSError, ValueError):
+            self.scan_cache = {}
+
+    def save_scan_cache(self):
+        # only keep files which have been scanned in this run, so that removed ones are pruned
+        if self.scan_cache is not None:
+            write_json(self.scan_cache_path, self.scanned_files)
+
+    def get_scan_key(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return [stat.st_mtime, stat.st_size]
+
+    def scan_files(self, filenames, kind):
+        """
+        Yield each of the given Python files (kind 'source') or templates (kind 'template') together
+        with the SASS/SCSS files it refers. Files which did not change since the previous run, are
+        taken from the scan cache. The remaining ones are parsed in a pool of processes, if more than
+        one job has been requested. Results and errors are reported in the order of `filenames`.
+        """
+        find_references = getattr(self, 'find_{}_references'.format(kind))
+        cached, pending = {}, []
+        for filename in filenames:
+            if self.scan_cache is not None:
+                entry = self.scan_cache.get(filename)
+                if entry and entry['stat'] == self.get_scan_key(filename):
+                    cached[filename] = entry
+                    continue
+            pending.append(filename)
+
+        executor, results, unreferring, parallel = None, None, set(), set()
+        if self.jobs > 1 and len(pending) > 1:
+            # only files which may refer SASS files are worth being sent to another process
+            matching = [filename for filename in pending if file_contains(filename, SCAN_PATTERNS[kind])]
+            unreferring = set(pending).difference(matching)
+            if len(matching) > 1:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    initializer=_init_scanner,
+                    initargs=(self.engine, self.verbosity),
+                )
+                chunksize = max(1, len(matching) // (self.jobs * 4))
+                results = executor.map(_scan_file, itertools.repeat(kind), matching, chunksize=chunksize)
+                parallel = set(matching)
+        try:
+            for filename in filenames:
+                if filename in cached:
+                    self.scanned_files[filename] = cached[filename]
+                    yield filename, cached[filename]['references']
+                    continue
+                key = self.get_scan_key(filename)
+                try:
+                    if filename in parallel:
+                        # results are delivered in the order of the submitted files
+                        references, errors = next(results)
+                        self.stderr.write(errors, ending='')
+                    elif filename in unreferring:
+                        references = []
+                    else:
+                        references = find_references(filename)
+                except (SyntaxError, IndentationError) as exc:
+                    msg = "Syntax error encountered processing {0}: {1}\nAborting compilation."
+                    self.stderr.write(msg.format(filename, exc))
+                    raise
+                if references is not None and key is not None:
+                    self.scanned_files[filename] = {'stat': key, 'references': references}
+                yield filename, references
+        finally:
+            if executor:
+                # cancels the pending chunks, in case scanning has been aborted
+                results.close()
+                executor.shutdown()
+
     def parse_source(self, filename):
         """
         Extract the statements from the given file, look for function calls
-        `sass_processor(scss_file)` and compile the filename into CSS.
+        `sass_processor(scss_file)` and remember the filename to be compiled into CSS.
         """
+        for _, references in self.scan_files([filename], 'source'):
+            for sass_fileurl in references:
+                self.add_sass_file(sass_fileurl, filename)
+
+    def find_source_references(self, filename):
+        source = Path(filename).read_bytes()
+        if not SASS_PROCESSOR_CALL.search(source):
+            # no need to parse files which can not invoke `sass_processor`
+            return []
         callvisitor = FuncCallVisitor('sass_processor')
-        tree = ast.parse(Path(filename).read_bytes())
+        tree = ast.parse(source)
         callvisitor.visit(tree)
-        for sass_fileurl in callvisitor.sass_files:
-            sass_filename = find_file(sass_fileurl)
-            if not sass_filename or sass_filename in self.processed_files:
-                continue
-            if self.delete_files:
-                self.delete_file(sass_filename, sass_fileurl)
-            else:
-                self.compile_sass(sass_filename, sass_fileurl)
+        return callvisitor.sass_files
+
+    def add_sass_file(self, sass_fileurl, referrer):
+        """
+        Remember a referred SASS/SCSS file, so that each one is processed only once, together with
+        the Python file or template referring it.
+        """
+        # resolve each path only once per run, also if the cache of `find_file` is disabled
+        try:
+            sass_filename = self.resolved_files[sass_fileurl]
+        except KeyError:
+            sass_filename = self.resolved_files[sass_fileurl] = find_file(sass_fileurl)
+        if not sass_filename:
+            return
+        if sass_filename not in self.sass_files:
+            self.sass_files[sass_filename] = sass_fileurl
+            self.references[sass_filename] = set()
+        self.references[sass_filename].add(referrer)
+
+    def list_references(self):
+        if self.verbosity > 0:
+            self.stdout.write("")
+        for sass_filename in sorted(self.sass_files):
+            self.stdout.write("{0} ({1})".format(self.sass_files[sass_filename], sass_filename))
+            for referrer in sorted(self.references[sass_filename]):
+                self.stdout.write("    {0}".format(referrer))
 
     def find_templates(self):
         """
@@ -241,6 +496,18 @@ class Command(BaseCommand):
         return templates
 
     def parse_template(self, template_name):
+        for _, references in self.scan_files([template_name], 'template'):
+            for sass_fileurl in references or []:
+                self.add_sass_file(sass_fileurl, template_name)
+
+    def find_template_references(self, template_name):
+        """
+        Return the SASS/SCSS files referred by the `sass_src` tags of the given template, or None if
+        the template can not be parsed.
+        """
+        if not file_contains(template_name, SASS_SRC_TAG):
+            # no need to parse templates which can not contain the tag `sass_src`
+            return []
         try:
             template = self.parser.parse(template_name)
         except IOError:  # unreadable file -> ignore
@@ -259,6 +526,7 @@ class Command(BaseCommand):
             if self.verbosity > 0:
                 self.stderr.write(
                     "\nUnicodeDecodeError while trying to read template {}".format(template_name))
+            return
         try:
             nodes = list(self.walk_nodes(template, original=template))
         except Exception as e:
@@ -266,34 +534,158 @@ class Command(BaseCommand):
             if self.verbosity > 0:
                 self.stderr.write("\nError parsing template {}: {}".format(template_name, e))
         else:
-            for node in nodes:
-                sass_filename = find_file(node.path)
-                if not sass_filename or sass_filename in self.processed_files:
-                    continue
-                if self.delete_files:
-                    self.delete_file(sass_filename, node.path)
-                else:
-                    self.compile_sass(sass_filename, node.path)
+            return [node.path for node in nodes]
+
+    def get_compile_kwargs(self, sass_filename):
+        compile_kwargs = self.profile.get_compile_kwargs(sass_filename, custom_functions=False)
+        compile_kwargs['omit_source_map_url'] = True
+        return compile_kwargs
+
+    def compile_sass_files(self):
+        """
+        Compile all collected SASS files into CSS. If more than one job has been requested, they
+        are compiled in a pool of processes, since libsass does not release the GIL. Results and
+        errors are reported in the order the files have been found.
+        """
+        if not self.fingerprints:
+            return self._compile_sass_files()
+        # write the fingerprints once, after all files have been compiled
+        with self.fingerprints.batch():
+            return self._compile_sass_files()
+
+    def _compile_sass_files(self):
+        sass_files = []
+        for sass_filename, sass_fileurl in self.sass_files.items():
+            if not self.is_affected(sass_filename, sass_fileurl) or self.is_unchanged(sass_filename, sass_fileurl):
+                self.skipped_files.append(sass_filename)
+                self.add_manifest_entry(sass_fileurl, self.fingerprints.get(sass_filename).get('digest'))
+                if self.verbosity > 1:
+                    self.stdout.write("Skipped unchanged SASS/SCSS file: '{0}'\n".format(sass_filename))
+            else:
+                sass_files.append((sass_filename, sass_fileurl))
+
+        compiled, errors = [], 0
+        try:
+            if self.jobs == 1 or len(sass_files) < 2:
+                for sass_filename, sass_fileurl in sass_files:
+                    try:
+                        content, sourcemap = self.compile_file(sass_filename)
+                    except sass.CompileError as exc:
+                        self.stderr.write("\nUnable to compile {}: {}".format(sass_filename, exc))
+                        errors += 1
+                    else:
+                        compiled.append((sass_filename, sass_fileurl, content, sourcemap))
+            else:
+                with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker) as executor:
+                    futures = [
+                        (sass_filename, sass_fileurl,
+                         executor.submit(_compile_sass, self.get_compile_kwargs(sass_filename)))
+                        for sass_filename, sass_fileurl in sass_files
+                    ]
+                    for sass_filename, sass_fileurl, future in futures:
+                        try:
+                            content, sourcemap = future.result()
+                        except sass.CompileError as exc:
+                            self.stderr.write("\nUnable to compile {}: {}".format(sass_filename, exc))
+                            errors += 1
+                        else:
+                            compiled.append((sass_filename, sass_fileurl, content, sourcemap))
+        finally:
+            # postprocess all compiled files in one batch, then save them
+            contents = postprocess([(sass_filename, force_bytes(content)) for sass_filename, _, content, _ in compiled])
+            for (sass_filename, sass_fileurl, _, sourcemap), content in zip(compiled, contents):
+                self.save_compiled(content, sourcemap, sass_filename, sass_fileurl)
+        if errors:
+            raise CommandError("{} SASS/SCSS files failed to compile.".format(errors))
+
+    def compile_file(self, sass_filename):
+        """
+        Compile the given SASS file and return the CSS together with its sourcemap
+        """
+        compile_kwargs = self.get_compile_kwargs(sass_filename)
+        compile_kwargs['custom_functions'] = self.profile.custom_functions
+        return sass.compile(**compile_kwargs)
 
     def compile_sass(self, sass_filename, sass_fileurl):
         """
         Compile the given SASS file into CSS
         """
-        compile_kwargs = {
-            'filename': sass_filename,
-            'include_paths': SassProcessor.include_paths + APPS_INCLUDE_DIRS,
-            'custom_functions': get_custom_functions(),
-        }
-        if self.sass_precision:
-            compile_kwargs['precision'] = self.sass_precision
-        if self.sass_output_style:
-            compile_kwargs['output_style'] = self.sass_output_style
-        content = sass.compile(**compile_kwargs)
-        self.save_to_destination(content, sass_filename, sass_fileurl)
-        self.processed_files.append(sass_filename)
+        content, sourcemap = self.compile_file(sass_filename)
+        content, = postprocess([(sass_filename, force_bytes(content))])
+        self.save_compiled(content, sourcemap, sass_filename, sass_fileurl)
+
+    def save_compiled(self, content, sourcemap, sass_filename, sass_fileurl):
+        destpath = self.save_to_destination(content, sass_filename, sass_fileurl)
+        if self.fingerprints:
+            base = os.path.dirname(sass_filename)
+            dependencies = [os.path.normpath(os.path.join(base, src)) for src in json.loads(sourcemap)['sources']]
+            source_digests = {srcfilename: self.fingerprints.get_file_digest(srcfilename)
+                              for srcfilename in dependencies}
+            fingerprint = compute_fingerprint(source_digests, self.get_fingerprint_options())
+            self.fingerprints.update(
+                sass_filename, destpath, dependencies, source_digests=source_digests,
+                fingerprint=fingerprint, options=self.get_options_digest(), digest=content_digest(content))
+        self.add_manifest_entry(sass_fileurl, content_digest(content))
+        self.processed_files.add(sass_filename)
         if self.verbosity > 1:
             self.stdout.write("Compiled SASS/SCSS file: '{0}'\n".format(sass_filename))
 
+    def add_manifest_entry(self, sass_fileurl, digest):
+        """
+        Remember the CSS file, as seen by the SASS processor, for the manifest. Its URL is not
+        resolved here, since static files usually are collected after running this command.
+        """
+        self.manifest_entries[sass_fileurl] = {
+            'css': os.path.splitext(sass_fileurl)[0] + '.css',
+            'hash': digest,
+        }
+
+    def get_fingerprint_options(self):
+        """
+        Return everything besides the SASS files themselves, which influences the compiled output.
+        """
+        return dict(
+            self.profile.get_options(),
+            postprocessors=get_postprocessor_signatures(),
+            use_storage=self.use_storage,
+        )
+
+    def get_options_digest(self):
+        return content_digest(json.dumps(self.get_fingerprint_options(), sort_keys=True).encode())
+
+    def is_affected(self, sass_filename, sass_fileurl):
+        """
+        If changed files are given, check if the given SASS file depends on one of them. Files which
+        have never been compiled before, whose destination file has been removed, or which have been
+        compiled with other options or postprocessors, are affected as well.
+        """
+        if not self.changed_files:
+            return True
+        entry = self.fingerprints.get(sass_filename)
+        if entry is None or entry.get('options') != self.get_options_digest():
+            return True
+        if not self.destination_exists(sass_filename, sass_fileurl):
+            return True
+        return any(sass_filename in self.fingerprints.get_dependents(f) for f in self.changed_files)
+
+    def is_unchanged(self, sass_filename, sass_fileurl):
+        """
+        In incremental mode, check if the given SASS file has been compiled before, and if neither
+        the destination file has been removed nor the fingerprint over its content, its dependencies
+        and the compiler options changed since then.
+        """
+        if not self.fingerprints:
+            return False
+        entry = self.fingerprints.get(sass_filename)
+        if entry is None:
+            return False
+        if not self.destination_exists(sass_filename, sass_fileurl):
+            return False
+        source_digests = self.fingerprints.get_source_digests(sass_filename)
+        if source_digests is None:
+            return False
+        return compute_fingerprint(source_digests, self.get_fingerprint_options()) == entry.get('fingerprint')
+
     def delete_file(self, sass_filename, sass_fileurl):
         """
         Delete a *.css file, but only if it has been generated through a SASS/SCSS file.
@@ -310,22 +702,44 @@ class Command(BaseCommand):
                 os.remove(destpath)
             else:
                 return
-        self.processed_files.append(sass_filename)
+        self.processed_files.add(sass_filename)
         if self.verbosity > 1:
             self.stdout.write("Deleted '{0}'\n".format(destpath))
 
+    def destination_exists(self, sass_filename, sass_fileurl):
+        destpath = self.get_destination(sass_filename, sass_fileurl)
+        if self.use_storage:
+            return self.storage.exists(destpath)
+        return os.path.isfile(destpath)
+
+    def get_destination(self, sass_filename, sass_fileurl):
+        if self.use_storage:
+            return os.path.splitext(sass_fileurl)[0] + '.css'
+        return os.path.splitext(sass_filename)[0] + '.css'
+
     def save_to_destination(self, content, sass_filename, sass_fileurl):
+        """
+        Save the compiled content, unless the destination already contains identical content.
+        For storages, this is determined through the digest recorded in incremental mode.
+        """
+        content = force_bytes(content)
+        destpath = self.get_destination(sass_filename, sass_fileurl)
         if self.use_storage:
-            basename, _ = os.path.splitext(sass_fileurl)
-            destpath = basename + '.css'
-            if self.storage.exists(destpath):
-                self.storage.delete(destpath)
-            self.storage.save(destpath, ContentFile(content))
+            entry = self.fingerprints.get(sass_filename) if self.fingerprints else None
+            unchanged = entry and entry.get('digest') == content_digest(content) and self.storage.exists(destpath)
+        else:
+            try:
+                unchanged = Path(destpath).read_bytes() == content
+            except OSError:
+                unchanged = False
+        if unchanged:
+            if self.verbosity > 1:
+                self.stdout.write("Output file '{0}' is unchanged\n".format(destpath))
+        elif self.use_storage:
+            save_file(self.storage, destpath, content)
         else:
-            basename, _ = os.path.splitext(sass_filename)
-            destpath = basename + '.css'
-            with open(destpath, 'wb') as fh:
-                fh.write(force_bytes(content))
+            write_file(destpath, content)
+        return destpath
 
     def walk_nodes(self, node, original):
         """
@@ -0,0 +1,60 @@
+import json
+import threading
+
+from sass_processor.utils import write_json
+
+
+class SassManifest:
+    """
+    A JSON file written by the management command `compilescss`, mapping each referred SASS/SCSS
+    file onto the CSS file it has been compiled into and the digest of its content. With the
+    processor disabled, this manifest is loaded once and then answers all lookups from memory.
+    URLs are not part of the manifest, since storages hashing the names of static files can only
+    determine them after `collectstatic` ran. Instead they are resolved once per process.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._entries = None
+        self._digests = None
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            entries = {}
+        self._set_entries(entries)
+
+    def _set_entries(self, entries):
+        with self._lock:
+            self._digests = {entry['css']: entry['hash'] for entry in entries.values()}
+            self._urls = {}
+            self._entries = entries
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self.load()
+        return self._entries
+
+    def get(self, path):
+        """Return the entry `{'css': ..., 'hash': ...}` for the given SASS file, or None."""
+        return self.entries.get(path)
+
+    def get_url(self, css_path, resolve_url):
+        """
+        Return the URL of the given compiled CSS file, or None if it is not listed. On first
+        request, the URL is resolved through `resolve_url(css_path, digest)` and then kept.
+        """
+        if self._digests is None:
+            self.load()
+        url = self._urls.get(css_path)
+        if url is None and css_path in self._digests:
+            url = self._urls[css_path] = resolve_url(css_path, self._digests[css_path])
+        return url
+
+    def write(self, entries):
+        write_json(self.path, entries)
+        self._set_entries(entries)
@@ -0,0 +1,210 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import struct
+import subprocess
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger('sass-processor')
+
+
+class PostcssError(Exception):
+    pass
+
+
+class PostcssWorker:
+    """
+    A long-lived node process running postcss with autoprefixer. CSS is sent through its stdin
+    and read back from its stdout, each message framed as JSON preceded by its length. The process
+    is started lazily on first use and restarted, if it died in the meantime. If it does not
+    respond within `timeout` seconds, it is killed and restarted on next use.
+    """
+    script = os.path.join(os.path.dirname(__file__), 'postcss_worker.js')
+
+    def __init__(self, node_path, node_modules_dir, timeout=30):
+        self.node_path = node_path
+        self.node_modules_dir = node_modules_dir
+        self.timeout = timeout
+        self._proc = None
+        self._responses = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        env = dict(os.environ, NODE_PATH=self.node_modules_dir)
+        self._proc = subprocess.Popen(
+            [self.node_path, self.script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        # responses are read by a separate thread, so that waiting for them can time out
+        self._responses = queue.Queue()
+        reader = threading.Thread(target=self._read_responses, args=(self._proc.stdout, self._responses),
+                                  name='postcss-worker-reader', daemon=True)
+        reader.start()
+
+    @staticmethod
+    def _read_responses(stdout, responses):
+        with stdout:
+            try:
+                while True:
+                    header = stdout.read(4)
+                    if len(header) < 4:
+                        break
+                    length, = struct.unpack('>I', header)
+                    payload = stdout.read(length)
+                    if len(payload) < length:
+                        break
+                    responses.put(payload)
+            except (OSError, ValueError):
+                pass
+        # signal the end of the output
+        responses.put(None)
+
+    def stop(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self._kill(proc)
+
+    def kill(self):
+        proc, self._proc = self._proc, None
+        if proc is not None:
+            self._kill(proc)
+
+    @staticmethod
+    def _kill(proc):
+        proc.kill()
+        proc.wait()
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    def _request(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        self._proc.stdin.write(struct.pack('>I', len(payload)) + payload)
+        self._proc.stdin.flush()
+        try:
+            payload = self._responses.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("postcss worker did not respond within {} seconds".format(self.timeout))
+        if payload is None:
+            raise EOFError("postcss worker terminated unexpectedly")
+        return json.loads(payload.decode('utf-8'))
+
+    def process(self, content, filename=None, sourcemap=False):
+        """
+        Return the given CSS content as bytes, postprocessed by postcss.
+        Raises `PostcssError` if the worker can not be started, or postcss reports an error.
+        """
+        [(content, error)] = self.process_batch([(filename, content)], sourcemap)
+        if error:
+            raise PostcssError(error)
+        return content
+
+    def process_batch(self, items, sourcemap=False):
+        """
+        Postprocess a list of `(filename, content)` tuples by postcss in one round-trip.
+        Return a list of `(content, error)` tuples in the same order, where `content` is None if
+        postcss reported an error for that item. Raises `PostcssError` if the worker can not be
+        started or does not respond in time.
+        """
+        message = {
+            'batch': [{'css': content.decode('utf-8'), 'from': filename} for filename, content in items],
+            'map': sourcemap,
+        }
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._proc is None or self._proc.poll() is not None:
+                        self.stop()
+                        self.start()
+                    response = self._request(message)
+                except TimeoutError as exc:
+                    # a hanging worker is not retried, but restarted on next use
+                    self.kill()
+                    raise PostcssError(str(exc)) from exc
+                except (OSError, EOFError, ValueError) as exc:
+                    self.stop()
+                    if attempt:
+                        raise PostcssError(str(exc)) from exc
+                else:
+                    break
+        return [
+            (result['css'].encode('utf-8'), None) if 'css' in result else (None, result['error'])
+            for result in response['results']
+        ]
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_postcss_worker(node_path, node_modules_dir):
+    """
+    Return the postcss worker shared by all callers using the same node executable and modules.
+    """
+    key = node_path, node_modules_dir
+    with _workers_lock:
+        if key not in _workers:
+            timeout = getattr(settings, 'SASS_PROCESSOR_POSTCSS_TIMEOUT', 30)
+            _workers[key] = PostcssWorker(node_path, node_modules_dir, timeout=timeout)
+        return _workers[key]
+
+
+def get_node_modules_dir():
+    nmd = [d[1] for d in getattr(settings, 'STATICFILES_DIRS', [])
+           if isinstance(d, (list, tuple)) and d[0] == 'node_modules']
+    return str(nmd[0]) if len(nmd) else None
+
+
+def get_node_path():
+    """
+    Return the path to the `node` executable. Unless `NODE_EXECUTABLE_PATH` is set, it is looked
+    up side-by-side with `NODE_NPX_PATH`, which was used to invoke postcss in previous versions.
+    """
+    node_path = getattr(settings, 'NODE_EXECUTABLE_PATH', None)
+    if node_path:
+        return str(node_path)
+    npx_dir = os.path.dirname(str(getattr(settings, 'NODE_NPX_PATH', None) or ''))
+    return os.path.join(npx_dir, 'node') if npx_dir else 'node'
+
+
+def autoprefix(items):
+    """
+    Postprocessor adding vendor prefixes to a list of `(filename, content)` tuples, if `node_modules`
+    has been configured in `STATICFILES_DIRS`. Return the list of postprocessed contents.
+    """
+    contents = [content for _, content in items]
+    node_modules_dir = get_node_modules_dir()
+    if not getattr(settings, 'NODE_NPX_PATH', 'npx') or not os.path.isdir(node_modules_dir or ''):
+        return contents
+    worker = get_postcss_worker(get_node_path(), node_modules_dir)
+    try:
+        results = worker.process_batch(items, sourcemap=settings.DEBUG)
+    except PostcssError as exc:
+        logger.warning("Unable to postcss {}. Reason: {}".format(', '.join(f for f, _ in items), exc))
+        return contents
+    for index, ((filename, content), (autoprefixed_content, error)) in enumerate(zip(items, results)):
+        if error:
+            logger.warning("Unable to postcss {}. Reason: {}".format(filename, error))
+        elif len(autoprefixed_content) >= len(content):
+            contents[index] = autoprefixed_content
+    return contents
+
+
+@atexit.register
+def stop_postcss_workers():
+    with _workers_lock:
+        for worker in _workers.values():
+            worker.stop()
+        _workers.clear()
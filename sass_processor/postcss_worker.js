@@ -0,0 +1,49 @@
+'use strict';
+
+// Long-lived postcss process used by django-sass-processor to add vendor prefixes.
+// Each request and response is a JSON object, preceded by its length as 4 byte big-endian integer.
+// A request contains a batch of CSS files, the response contains the results in the same order.
+// Requests are processed in the order they arrive.
+
+const postcss = require('postcss');
+const autoprefixer = require('autoprefixer');
+
+const processor = postcss([autoprefixer]);
+let buffer = Buffer.alloc(0);
+let queue = Promise.resolve();
+
+function send(message) {
+  const payload = Buffer.from(JSON.stringify(message), 'utf8');
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(payload.length, 0);
+  process.stdout.write(Buffer.concat([header, payload]));
+}
+
+function processItem(item, map) {
+  const options = {from: item.from, map: map ? {inline: true} : false};
+  return Promise.resolve()
+    .then(() => processor.process(item.css, options))
+    .then(result => ({css: result.css}), error => ({error: String(error)}));
+}
+
+function handle(request) {
+  return Promise.all(request.batch.map(item => processItem(item, request.map)))
+    .then(results => send({results: results}));
+}
+
+process.stdin.on('data', chunk => {
+  buffer = Buffer.concat([buffer, chunk]);
+  while (buffer.length >= 4) {
+    const length = buffer.readUInt32BE(0);
+    if (buffer.length < 4 + length) {
+      break;
+    }
+    const request = JSON.parse(buffer.subarray(4, 4 + length).toString('utf8'));
+    buffer = buffer.subarray(4 + length);
+    queue = queue.then(() => handle(request));
+  }
+});
+
+process.stdin.on('end', () => {
+  queue.then(() => process.exit(0));
+});
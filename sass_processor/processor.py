@@ -1,23 +1,26 @@
 import os
 import json
 import logging
-import subprocess
+import threading
+import time
+from functools import lru_cache
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files.base import ContentFile
 from django.template import Context
 from django.utils.encoding import force_bytes
 
-from sass_processor.utils import get_custom_functions
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
-from .storage import SassFileStorage, find_file
-from .apps import APPS_INCLUDE_DIRS
+from sass_processor.utils import get_postprocessor_signatures, get_sass, postprocess
 
-try:
-    import sass
-except ImportError:
-    sass = None
+from .dependencies import DependencyIndex, compute_fingerprint, content_digest, file_digest
+from .locks import compile_lock
+from .manifest import SassManifest
+from .profile import CompileProfile
+from .storage import SassFileStorage, discard_file, find_file, save_file
+from .apps import get_apps_include_dirs
 
 logger = logging.getLogger('sass-processor')
 
@@ -35,16 +38,51 @@ class SassProcessor:
         'nested' if settings.DEBUG else 'compressed')
     processor_enabled = getattr(settings, 'SASS_PROCESSOR_ENABLED', settings.DEBUG)
     fail_silently = getattr(settings, 'SASS_PROCESSOR_FAIL_SILENTLY', not settings.DEBUG)
+    cache_busting = getattr(settings, 'SASS_PROCESSOR_CACHE_BUSTING', False)
     sass_extensions = ('.scss', '.sass')
-    node_npx_path = getattr(settings, 'NODE_NPX_PATH', 'npx')
+    cache_timeout = getattr(settings, 'SASS_PROCESSOR_CACHE_TIMEOUT', 0)
+    lock_dir = getattr(settings, 'SASS_PROCESSOR_LOCK_DIR', None)
+    output_cache = getattr(settings, 'SASS_PROCESSOR_OUTPUT_CACHE', None)
+    watch = getattr(settings, 'SASS_PROCESSOR_WATCH', False)
+    watch_interval = getattr(settings, 'SASS_PROCESSOR_WATCH_INTERVAL', 1.0)
+    watcher = None
+    _watcher_lock = threading.Lock()
+    dependency_index = getattr(settings, 'SASS_PROCESSOR_DEPENDENCY_INDEX', None)
+    if dependency_index:
+        dependency_index = DependencyIndex(
+            dependency_index, use_hashes=getattr(settings, 'SASS_PROCESSOR_CONTENT_HASHING', False))
+    elif getattr(settings, 'SASS_PROCESSOR_CONTENT_HASHING', False):
+        raise ImproperlyConfigured("SASS_PROCESSOR_CONTENT_HASHING requires SASS_PROCESSOR_DEPENDENCY_INDEX")
+    manifest = getattr(settings, 'SASS_PROCESSOR_MANIFEST', None)
+    if manifest:
+        manifest = SassManifest(manifest)
+    _freshness_cache = {}
+    _output_digests = {}
+    _verified_outputs = set()
+    _output_mtimes = {}
+    _freshness_lock = threading.Lock()
+    _compile_profile = None
+    _compile_profile_lock = threading.Lock()
 
     def __init__(self, path=None):
         self._path = path
-        nmd = [d[1] for d in getattr(settings, 'STATICFILES_DIRS', [])
-               if isinstance(d, (list, tuple)) and d[0] == 'node_modules']
-        self.node_modules_dir = str(nmd[0]) if len(nmd) else None
 
     def __call__(self, path):
+        if self.watch and self.watcher is None and self.processor_enabled:
+            # start the watcher only in processes actually serving SASS files
+            self.start_watcher(self.watch_interval)
+
+        if self.uses_manifest() and path.endswith(self.sass_extensions):
+            entry = self.manifest.get(path)
+            if entry is None:
+                msg = "File `{}` is missing in manifest `{}`. Run `./manage.py compilescss` to build it."
+                raise ImproperlyConfigured(msg.format(path, self.manifest.path))
+            return entry['css']
+
+        css_filename = self.get_cached(path)
+        if css_filename is not None:
+            return css_filename
+
         basename, ext = os.path.splitext(path)
         filename = find_file(path)
         if filename is None:
@@ -52,69 +90,140 @@ class SassProcessor:
 
         if ext not in self.sass_extensions:
             # return the given path, since it ends neither in `.scss` nor in `.sass`
+            self.set_cached(path, path, [])
             return path
 
         # compare timestamp of sourcemap file with all its dependencies, and check if we must recompile
         css_filename = basename + '.css'
         if not self.processor_enabled:
+            self.set_cached(path, css_filename, [])
             return css_filename
-        sourcemap_filename = css_filename + '.map'
-        base = os.path.dirname(filename)
-        if self.source_storage.exists(css_filename) and self.is_latest(sourcemap_filename, base):
+        dependencies = self.find_dependencies(filename, css_filename)
+        if dependencies is not None:
+            self.set_cached(path, css_filename, dependencies)
             return css_filename
 
         # with offline compilation, raise an error, if css file could not be found.
-        if sass is None:
+        if get_sass() is None:
             msg = "Offline compiled file `{}` is missing and libsass has not been installed."
             raise ImproperlyConfigured(msg.format(css_filename))
 
-        # otherwise compile the SASS/SCSS file into .css and store it
-        filename_map = filename.replace(ext, '.css.map')
-        compile_kwargs = {
-            'filename': filename,
-            'source_map_filename': filename_map,
-            'include_paths': self.include_paths + APPS_INCLUDE_DIRS,
-            'custom_functions': get_custom_functions(),
-        }
-        if self.sass_precision:
-            compile_kwargs['precision'] = self.sass_precision
-        if self.sass_output_style:
-            compile_kwargs['output_style'] = self.sass_output_style
-        try:
-            content, sourcemap = (force_bytes(output) for output in sass.compile(**compile_kwargs))
-        except sass.CompileError as exc:
-            if self.fail_silently:
-                content, sourcemap = force_bytes(exc), None
-                logger.error(exc)
+        # otherwise compile the SASS/SCSS file into .css and store it, but only once at a time
+        with compile_lock(css_filename, self.lock_dir):
+            # another thread or process may have compiled that file, while waiting for the lock
+            if self.dependency_index:
+                self.dependency_index.clear()
+            dependencies = self.find_dependencies(filename, css_filename)
+            if dependencies is not None:
+                self.set_cached(path, css_filename, dependencies)
             else:
-                raise exc
+                self.compile(path, filename, css_filename)
+        return css_filename
 
-        # autoprefix CSS files using postcss in external JavaScript process
-        if self.node_npx_path and os.path.isdir(self.node_modules_dir or ''):
-            os.environ['NODE_PATH'] = self.node_modules_dir
+    def compile(self, path, filename, css_filename):
+        sourcemap_filename = css_filename + '.map'
+        base = os.path.dirname(filename)
+        compile_kwargs = self.get_compile_profile().get_compile_kwargs(filename)
+        cached_output = self.get_cached_output(filename, compile_kwargs) if self.output_cache else None
+        if cached_output:
+            content, sourcemap = cached_output
+        else:
+            sass = get_sass()
             try:
-                options = [self.node_npx_path, 'postcss', '--use', 'autoprefixer']
-                if not settings.DEBUG:
-                    options.append('--no-map')
-                proc = subprocess.Popen(options, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                proc.stdin.write(content)
-                proc.stdin.close()
-                autoprefixed_content = proc.stdout.read()
-                proc.wait()
-            except (FileNotFoundError, BrokenPipeError) as exc:
-                logger.warning("Unable to postcss {}. Reason: {}".format(filename, exc))
-            else:
-                if len(autoprefixed_content) >= len(content):
-                    content = autoprefixed_content
+                content, sourcemap = (force_bytes(output) for output in sass.compile(**compile_kwargs))
+            except sass.CompileError as exc:
+                if self.fail_silently:
+                    content, sourcemap = force_bytes(exc), None
+                    logger.error(exc)
+                else:
+                    raise exc
 
-        if self.source_storage.exists(css_filename):
-            self.source_storage.delete(css_filename)
-        self.source_storage.save(css_filename, ContentFile(content))
-        if self.source_storage.exists(sourcemap_filename):
-            self.source_storage.delete(sourcemap_filename)
+            # postprocess CSS files, by default autoprefixing them using postcss
+            content, = postprocess([(filename, content)])
+
+        # skip writing files with unchanged content. The previous digests are taken from the dependency
+        # index, re-read while holding the compile lock, otherwise from the stored CSS file itself,
+        # since another process may have overwritten it. Without a dependency index, the sourcemap
+        # must be rewritten anyway, since its modification time is used to determine freshness.
+        previous = self.dependency_index.get(filename) if self.dependency_index else None
+        if previous:
+            css_digest, map_digest = previous.get('digest'), previous.get('map_digest')
+        else:
+            css_digest, map_digest = self.get_output_digest(css_filename), None
+        css_digest = self.save_output(css_filename, content, css_digest)
+        self._output_digests[css_filename] = css_digest
+        if self.cache_busting and not self.dependency_index:
+            self._output_mtimes[css_filename] = self.get_output_mtime(css_filename)
         if sourcemap:
-            self.source_storage.save(sourcemap_filename, ContentFile(sourcemap))
-        return css_filename
+            map_digest = self.save_output(sourcemap_filename, sourcemap, map_digest)
+            sources = json.loads(sourcemap.decode('utf-8')).get('sources', [])
+            dependencies = [os.path.normpath(os.path.join(base, src)) for src in sources]
+            self.set_cached(path, css_filename, dependencies)
+            if self.output_cache and not cached_output:
+                self.set_cached_output(filename, compile_kwargs, dependencies, content, sourcemap)
+            if self.dependency_index:
+                self.dependency_index.update(
+                    filename, css_filename, dependencies, digest=css_digest, map_digest=map_digest)
+                self._verified_outputs.add(css_filename)
+        else:
+            discard_file(self.source_storage, sourcemap_filename)
+            if self.dependency_index:
+                self.dependency_index.discard(filename)
+
+    def get_output_cache_key(self, kind, value):
+        return 'sass_processor:{}:{}'.format(kind, content_digest(force_bytes(value)))
+
+    def get_output_fingerprint(self, compile_kwargs, dependencies):
+        """
+        Return a fingerprint over the content of all dependencies and the compiler options, or None
+        if one of the dependencies is missing.
+        """
+        try:
+            source_digests = {srcfilename: file_digest(srcfilename) for srcfilename in dependencies}
+        except OSError:
+            return None
+        options = dict(compile_kwargs, **self.get_compile_profile().get_options())
+        options['postprocessors'] = get_postprocessor_signatures()
+        return compute_fingerprint(source_digests, options)
+
+    def get_cached_output(self, filename, compile_kwargs):
+        """
+        Return the CSS content and sourcemap, compiled from the given SASS file by any process sharing
+        the cache configured in `SASS_PROCESSOR_OUTPUT_CACHE`, or None if none of them compiled its
+        current content. The dependencies recorded at the last compilation are used to determine
+        the fingerprint of that content.
+        """
+        from django.core.cache import caches
+
+        cache = caches[self.output_cache]
+        dependencies = cache.get(self.get_output_cache_key('dependencies', filename))
+        if not dependencies:
+            return None
+        fingerprint = self.get_output_fingerprint(compile_kwargs, dependencies)
+        if fingerprint is None:
+            return None
+        return cache.get(self.get_output_cache_key('output', fingerprint))
+
+    def set_cached_output(self, filename, compile_kwargs, dependencies, content, sourcemap):
+        fingerprint = self.get_output_fingerprint(compile_kwargs, dependencies)
+        if fingerprint is None:
+            return
+        from django.core.cache import caches
+
+        caches[self.output_cache].set_many({
+            self.get_output_cache_key('dependencies', filename): dependencies,
+            self.get_output_cache_key('output', fingerprint): (content, sourcemap),
+        })
+
+    def save_output(self, name, content, previous_digest):
+        """
+        Save the content into the storage, unless it is identical to the previously saved one.
+        Return the digest of the content.
+        """
+        digest = content_digest(content)
+        if digest != previous_digest or not self.source_storage.exists(name):
+            save_file(self.source_storage, name, content)
+        return digest
 
     def resolve_path(self, context=None):
         if context is None:
@@ -125,22 +234,215 @@ class SassProcessor:
         _, ext = os.path.splitext(self.resolve_path())
         return ext in self.sass_extensions
 
+    def find_dependencies(self, filename, css_filename):
+        """
+        Return the list of files the compiled CSS file depends on, or None if it must be
+        recompiled. If `SASS_PROCESSOR_DEPENDENCY_INDEX` is configured, this information is taken
+        from there, otherwise it is taken from the sourcemap stored side-by-side with the CSS file.
+        """
+        if self.dependency_index:
+            dependencies = self.dependency_index.get_dependencies(filename)
+            if dependencies is not None:
+                if css_filename not in self._verified_outputs:
+                    # the index can not tell whether the compiled file has been removed since, hence
+                    # check its existence once per process
+                    if not self.source_storage.exists(css_filename):
+                        return None
+                    self._verified_outputs.add(css_filename)
+                # remember the digest of the compiled file, it is used to version its URL
+                digest = self.dependency_index.get(filename).get('digest')
+                if digest:
+                    self._output_digests[css_filename] = digest
+            return dependencies
+        if self.source_storage.exists(css_filename):
+            dependencies = self.get_dependencies(css_filename + '.map', os.path.dirname(filename))
+            if dependencies is not None and self.cache_busting:
+                self.revalidate_output_digest(css_filename)
+            return dependencies
+
     def is_latest(self, sourcemap_file, base):
+        return self.get_dependencies(sourcemap_file, base) is not None
+
+    def get_dependencies(self, sourcemap_file, base):
+        """
+        Return the list of absolute filenames the compiled CSS file depends on, or None if any of
+        them is younger than the sourcemap referring it, meaning that the CSS file must be recompiled.
+        """
         if not self.source_storage.exists(sourcemap_file):
-            return False
+            return None
         sourcemap_mtime = self.source_storage.get_modified_time(sourcemap_file).timestamp()
         with self.source_storage.open(sourcemap_file, 'r') as fp:
             sourcemap = json.load(fp)
+        dependencies = []
         for srcfilename in sourcemap.get('sources'):
             srcfilename = os.path.join(base, srcfilename)
             if not os.path.isfile(srcfilename) or os.stat(srcfilename).st_mtime > sourcemap_mtime:
                 # at least one of the source is younger that the sourcemap referring it
-                return False
-        return True
+                return None
+            dependencies.append(srcfilename)
+        return dependencies
+
+    def get_cached(self, path):
+        """
+        Return the CSS path for the given SASS path from the in-process freshness cache, or None if
+        there is no entry or one of its dependencies has been modified since it was checked.
+        Entries are revalidated every `SASS_PROCESSOR_CACHE_TIMEOUT` seconds by comparing the
+        modification times of their dependencies. If that setting is `None`, entries never expire.
+        """
+        if self.cache_timeout == 0:
+            return None
+        entry = self._freshness_cache.get(path)
+        if entry is None:
+            return None
+        css_filename, dependencies, checked_at = entry
+        now = time.monotonic()
+        if self.cache_timeout is None or now - checked_at < self.cache_timeout:
+            return css_filename
+        for srcfilename, mtime in dependencies.items():
+            try:
+                if os.stat(srcfilename).st_mtime != mtime:
+                    break
+            except OSError:
+                break
+        else:
+            with self._freshness_lock:
+                self._freshness_cache[path] = css_filename, dependencies, now
+            return css_filename
+        with self._freshness_lock:
+            self._freshness_cache.pop(path, None)
+
+    def set_cached(self, path, css_filename, dependencies):
+        if self.watcher:
+            self.watcher.register(path, dependencies)
+        if self.cache_timeout == 0:
+            return
+        try:
+            dependencies = {srcfilename: os.stat(srcfilename).st_mtime for srcfilename in dependencies}
+        except OSError:
+            return
+        with self._freshness_lock:
+            self._freshness_cache[path] = css_filename, dependencies, time.monotonic()
+
+    @classmethod
+    def discard_cached(cls, path):
+        with cls._freshness_lock:
+            cls._freshness_cache.pop(path, None)
+
+    @classmethod
+    def start_watcher(cls, interval):
+        """
+        Start a thread recompiling SASS files in the background, as soon as their dependencies change.
+        """
+        from sass_processor.watcher import SassWatcher
+
+        with cls._watcher_lock:
+            if cls.watcher is None:
+                cls.watcher = SassWatcher(_sass_processor, interval)
+                cls.watcher.start()
+        return cls.watcher
+
+    @classmethod
+    def checks_freshness(cls):
+        """
+        Return False, if a resolved CSS file never has to be checked for freshness again, because
+        the processor is disabled, or because cached results never expire.
+        """
+        return cls.processor_enabled and cls.cache_timeout is not None
+
+    @classmethod
+    def uses_manifest(cls):
+        """
+        Return True, if compiled files are looked up in `SASS_PROCESSOR_MANIFEST` only.
+        """
+        return bool(cls.manifest) and not cls.processor_enabled
+
+    @classmethod
+    def get_compile_profile(cls):
+        """
+        Return the compiler options shared by all SASS processors, built on first use.
+        """
+        profile = cls._compile_profile
+        if profile is None:
+            # do not block freshness checks, while looking for the include folders of all apps
+            with cls._compile_profile_lock:
+                if cls._compile_profile is None:
+                    cls._compile_profile = CompileProfile(
+                        cls.include_paths + get_apps_include_dirs(),
+                        precision=cls.sass_precision,
+                        output_style=cls.sass_output_style,
+                    )
+                profile = cls._compile_profile
+        return profile
+
+    @classmethod
+    def reset_compile_profile(cls):
+        with cls._compile_profile_lock:
+            cls._compile_profile = None
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._freshness_lock:
+            cls._freshness_cache.clear()
+            cls._output_digests.clear()
+            cls._verified_outputs.clear()
+            cls._output_mtimes.clear()
+        cls.reset_compile_profile()
+        cls.get_url.cache_clear()
 
     @classmethod
     def handle_simple(cls, path):
-        return cls.source_storage.url(path)
+        """
+        Return the URL of the given file in the storage. URLs are cached by path and the digest of
+        the file's content, if known. If `SASS_PROCESSOR_CACHE_BUSTING` is set, a query string
+        derived from that digest is appended to the URL.
+        """
+        if cls.uses_manifest():
+            url = cls.manifest.get_url(path, cls.get_url)
+            if url is not None:
+                return url
+        if path not in cls._output_digests and cls.cache_busting:
+            cls._output_digests[path] = cls.get_output_digest(path)
+        return cls.get_url(path, cls._output_digests.get(path))
+
+    @classmethod
+    def revalidate_output_digest(cls, path):
+        """
+        Recompute the digest of the given compiled file, if it has been modified since that digest
+        was taken, for instance because another process recompiled it.
+        """
+        mtime = cls.get_output_mtime(path)
+        if mtime is None or cls._output_mtimes.get(path) != mtime:
+            cls._output_digests[path] = cls.get_output_digest(path)
+            cls._output_mtimes[path] = mtime
+
+    @classmethod
+    def get_output_mtime(cls, path):
+        try:
+            return cls.source_storage.get_modified_time(path).timestamp()
+        except (OSError, NotImplementedError):
+            return None
+
+    @classmethod
+    def get_output_digest(cls, path):
+        try:
+            with cls.source_storage.open(path, 'rb') as fp:
+                return content_digest(fp.read())
+        except OSError:
+            return None
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def get_url(cls, path, digest):
+        url = cls.source_storage.url(path)
+        if cls.cache_busting and digest:
+            url += ('&' if '?' in url else '?') + 'v=' + digest[:12]
+        return url
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    if setting in ('SASS_PROCESSOR_CUSTOM_FUNCTIONS', 'SASS_PROCESSOR_POSTPROCESSORS'):
+        SassProcessor.reset_compile_profile()
 
 
 _sass_processor = SassProcessor()
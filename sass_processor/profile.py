@@ -0,0 +1,85 @@
+import os
+import threading
+
+from sass_processor.utils import build_custom_functions, build_postprocessors
+
+
+class CompileProfile:
+    """
+    The options passed to libsass for each SASS/SCSS file, shared by the SASS processor and the
+    management command `compilescss`. Include paths are normalized and deduplicated once, and the
+    set of custom functions as well as the postprocessors are built on first use and then frozen.
+    """
+    def __init__(self, include_paths=(), precision=None, output_style=None, custom_functions=None,
+                 postprocessors=None):
+        normalized_paths = []
+        for include_path in include_paths:
+            include_path = os.path.normpath(os.path.abspath(str(include_path)))
+            if include_path not in normalized_paths:
+                normalized_paths.append(include_path)
+        self.include_paths = tuple(normalized_paths)
+        self.precision = precision
+        self.output_style = output_style
+        self._custom_functions = custom_functions
+        self._postprocessors = postprocessors
+        self._lock = threading.Lock()
+
+    @property
+    def custom_functions(self):
+        if self._custom_functions is None:
+            with self._lock:
+                if self._custom_functions is None:
+                    self._custom_functions = build_custom_functions()
+        return self._custom_functions
+
+    @property
+    def postprocessors(self):
+        if self._postprocessors is None:
+            with self._lock:
+                if self._postprocessors is None:
+                    self._postprocessors = build_postprocessors()
+        return self._postprocessors
+
+    def replace(self, **options):
+        """Return a copy of this profile with some options replaced."""
+        kwargs = dict({'precision': self.precision, 'output_style': self.output_style}, **options)
+        return CompileProfile(self.include_paths, custom_functions=self._custom_functions,
+                              postprocessors=self._postprocessors, **kwargs)
+
+    def get_compile_kwargs(self, filename, custom_functions=True):
+        """
+        Return the keyword arguments for `sass.compile()` to compile the given file. Without
+        `custom_functions`, they can be pickled and passed to another process.
+        """
+        compile_kwargs = {
+            'filename': filename,
+            'source_map_filename': os.path.splitext(filename)[0] + '.css.map',
+            'include_paths': list(self.include_paths),
+        }
+        if custom_functions:
+            compile_kwargs['custom_functions'] = self.custom_functions
+        if self.precision:
+            compile_kwargs['precision'] = self.precision
+        if self.output_style:
+            compile_kwargs['output_style'] = self.output_style
+        return compile_kwargs
+
+    def get_custom_function_signatures(self):
+        """
+        Return a sorted list of strings identifying the custom functions, as they can not be serialized
+        """
+        return sorted(
+            '{0}{1}:{2.__module__}.{2.__qualname__}'.format(func.name, func.arguments, func.callable_)
+            for func in self.custom_functions
+        )
+
+    def get_options(self):
+        """
+        Return all options influencing the compiled output, in a serializable form.
+        """
+        return {
+            'include_paths': list(self.include_paths),
+            'precision': self.precision,
+            'output_style': self.output_style,
+            'custom_functions': self.get_custom_function_signatures(),
+        }
@@ -1,7 +1,14 @@
+import os
+import secrets
+from functools import lru_cache
+
 from django import VERSION
 from django.conf import settings
 from django.contrib.staticfiles.finders import get_finders
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.functional import LazyObject
 from django.utils.module_loading import import_string
 
@@ -32,8 +39,87 @@ class SassFileStorage(LazyObject):
         self._wrapped = storage_class(**storage_options)
 
 
-def find_file(path):
+def _find_file(path):
     for finder in get_finders():
         result = finder.find(path)
         if result:
             return result
+
+
+_cached_find_file = None
+
+
+def find_file(path):
+    """
+    Return the absolute filename of `path` as located by the staticfiles finders. Results are kept
+    in an LRU cache holding `SASS_PROCESSOR_FINDER_CACHE_SIZE` entries. In DEBUG mode, this cache
+    is disabled by default, since files may be added while developing.
+    """
+    global _cached_find_file
+    if _cached_find_file is None:
+        maxsize = getattr(settings, 'SASS_PROCESSOR_FINDER_CACHE_SIZE', 0 if settings.DEBUG else 1024)
+        _cached_find_file = lru_cache(maxsize=maxsize)(_find_file) if maxsize else _find_file
+    return _cached_find_file(path)
+
+
+def clear_find_file_cache():
+    """
+    Forget all located files, for instance after static files have been added or removed.
+    """
+    global _cached_find_file
+    _cached_find_file = None
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    if setting in ['DEBUG', 'INSTALLED_APPS', 'STATICFILES_DIRS', 'STATICFILES_FINDERS',
+                   'SASS_PROCESSOR_FINDER_CACHE_SIZE']:
+        clear_find_file_cache()
+
+
+def write_file(path, content):
+    """
+    Atomically replace the file at `path` by writing `content` into a temporary file in the same
+    directory and renaming it, so that concurrent readers never see a missing or partial file.
+    """
+    dirname, basename = os.path.split(path)
+    tmpname = os.path.join(dirname, '.{}.{}.tmp'.format(basename, secrets.token_hex(8)))
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def save_file(storage, name, content):
+    """
+    Save `content` as `name` into the given storage, replacing any existing file. For filesystem
+    based storages, the file is replaced atomically. Storages which overwrite existing files by
+    themselves, are invoked directly, without checking for an existing file before.
+    """
+    if isinstance(storage, FileSystemStorage):
+        path = storage.path(name)
+        if os.path.isdir(os.path.dirname(path)):
+            write_file(path, content)
+            if storage.file_permissions_mode is not None:
+                os.chmod(path, storage.file_permissions_mode)
+            return name
+    elif not getattr(storage, 'file_overwrite', False) and storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, ContentFile(content))
+
+
+def discard_file(storage, name):
+    """
+    Delete the file `name` from the given storage, if it exists.
+    """
+    if isinstance(storage, FileSystemStorage):
+        try:
+            os.remove(storage.path(name))
+        except FileNotFoundError:
+            pass
+    elif storage.exists(name):
+        storage.delete(name)
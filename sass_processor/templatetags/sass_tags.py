@@ -13,6 +13,9 @@ register = Library()
 class SassSrcNode(Node):
     def __init__(self, path):
         self.sass_processor = SassProcessor(path)
+        # the URL of a constant path without filters has to be resolved only once
+        self.is_constant = isinstance(path.var, str) and not path.filters
+        self.url = None
 
     @classmethod
     def handle_token(cls, parser, token):
@@ -31,6 +34,8 @@ class SassSrcNode(Node):
         return self.sass_processor.is_sass()
 
     def render(self, context):
+        if self.url is not None:
+            return self.url
         try:
             path = self.sass_processor(self.sass_processor.resolve_path(context))
         except AttributeError as e:
@@ -39,7 +44,10 @@ class SassSrcNode(Node):
         except FileNotFoundError as e:
             msg = str(e) + " while rendering tag 'sass_src' in template {}"
             raise TemplateSyntaxError(msg.format(context.template_name))
-        return SassProcessor.handle_simple(path)
+        url = SassProcessor.handle_simple(path)
+        if self.is_constant and not SassProcessor.checks_freshness():
+            self.url = url
+        return url
 
 
 @register.tag(name='sass_src')
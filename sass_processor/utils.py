@@ -1,28 +1,38 @@
 import inspect
+import json
+import os
+import tempfile
 
 from django.conf import settings
 from django.template import TemplateSyntaxError
 from django.utils.module_loading import import_string
 
-try:
-    import sass
-except ImportError:
-    sass = None
 
+def get_sass():
+    """
+    Return the libsass module, or None if it has not been installed. It is imported on first use,
+    so that processes serving precompiled CSS files never load that native extension.
+    """
+    try:
+        import sass
+    except ImportError:
+        return None
+    return sass
 
-def get_custom_functions():
+
+def build_custom_functions():
     """
-    Return a dict of function names, to be used from inside SASS
+    Return a frozen set of functions, to be used from inside SASS
     """
+    import sass
+
     def get_setting(*args):
         try:
             return getattr(settings, args[0])
         except AttributeError as e:
             raise TemplateSyntaxError(str(e))
 
-    if hasattr(get_custom_functions, '_custom_functions'):
-        return get_custom_functions._custom_functions
-    get_custom_functions._custom_functions = {sass.SassFunction('get-setting', ('key',), get_setting)}
+    custom_functions = {sass.SassFunction('get-setting', ('key',), get_setting)}
     for name, func in getattr(settings, 'SASS_PROCESSOR_CUSTOM_FUNCTIONS', {}).items():
         try:
             if isinstance(func, str):
@@ -34,5 +44,69 @@ def get_custom_functions():
                 raise TemplateSyntaxError("{} is not a Python function".format(func))
             func_args = inspect.getfullargspec(func).args
             sass_func = sass.SassFunction(name, func_args, func)
-            get_custom_functions._custom_functions.add(sass_func)
-    return get_custom_functions._custom_functions
+            custom_functions.add(sass_func)
+    return frozenset(custom_functions)
+
+
+def get_custom_functions():
+    """
+    Return the set of functions, to be used from inside SASS, as kept by the shared compile profile
+    """
+    from sass_processor.processor import SassProcessor
+
+    return SassProcessor.get_compile_profile().custom_functions
+
+
+def build_postprocessors():
+    """
+    Return a tuple of the postprocessors configured in `SASS_PROCESSOR_POSTPROCESSORS`
+    """
+    postprocessors = []
+    for func in getattr(settings, 'SASS_PROCESSOR_POSTPROCESSORS', ['sass_processor.postcss.autoprefix']):
+        if isinstance(func, str):
+            func = import_string(func)
+        postprocessors.append(func)
+    return tuple(postprocessors)
+
+
+def get_postprocessors():
+    """
+    Return the postprocessors, as kept by the shared compile profile
+    """
+    from sass_processor.processor import SassProcessor
+
+    return SassProcessor.get_compile_profile().postprocessors
+
+
+def get_postprocessor_signatures():
+    """
+    Return a list of strings identifying the configured postprocessors, as they can not be serialized
+    """
+    return ['{0.__module__}.{0.__qualname__}'.format(func) for func in get_postprocessors()]
+
+
+def postprocess(items):
+    """
+    Pass a list of `(filename, content)` tuples, with `content` being compiled CSS, through all
+    configured postprocessors and return the list of postprocessed contents.
+    """
+    contents = [content for _, content in items]
+    for postprocessor in get_postprocessors():
+        contents = postprocessor([(filename, content) for (filename, _), content in zip(items, contents)])
+    return contents
+
+
+def write_json(path, data):
+    """
+    Atomically replace the file at `path` with the JSON representation of `data`.
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname or '.', exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname or None, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(data, fp, sort_keys=True)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
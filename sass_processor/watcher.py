@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger('sass-processor')
+
+
+class SassWatcher(threading.Thread):
+    """
+    A background thread recompiling SASS/SCSS files as soon as one of their dependencies changed,
+    so that requests find fresh CSS files rather than having to compile them.
+
+    Each file resolved by the SASS processor is registered together with its dependencies and
+    their modification times. Every `interval` seconds, the watcher polls these dependencies once
+    each, and then recompiles all files depending on those which have been modified.
+    """
+    def __init__(self, processor, interval=1.0):
+        super().__init__(name='sass-processor-watcher', daemon=True)
+        self.processor = processor
+        self.interval = interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def register(self, path, dependencies):
+        """
+        Watch the given dependencies of a SASS file, referred by the same path as used in templates.
+        """
+        mtimes = {}
+        for srcfilename in dependencies:
+            try:
+                mtimes[srcfilename] = os.stat(srcfilename).st_mtime
+            except OSError:
+                continue
+        if mtimes:
+            with self._lock:
+                self._entries[path] = mtimes
+
+    def get_dependents(self, entries=None):
+        """
+        Return a mapping of each watched dependency onto the set of paths depending on it.
+        """
+        if entries is None:
+            with self._lock:
+                entries = dict(self._entries)
+        dependents = {}
+        for path, mtimes in entries.items():
+            for srcfilename in mtimes:
+                dependents.setdefault(srcfilename, set()).add(path)
+        return dependents
+
+    def poll(self):
+        """
+        Return the sorted list of paths with at least one dependency modified since registration.
+        Each dependency is checked once, even if shared by many paths.
+        """
+        with self._lock:
+            entries = dict(self._entries)
+        modified = set()
+        for srcfilename, paths in self.get_dependents(entries).items():
+            try:
+                mtime = os.stat(srcfilename).st_mtime
+            except OSError:
+                mtime = None
+            modified.update(path for path in paths if entries[path][srcfilename] != mtime)
+        return sorted(modified)
+
+    def check(self):
+        for path in self.poll():
+            with self._lock:
+                dependencies = list(self._entries.get(path, ()))
+            self.processor.discard_cached(path)
+            try:
+                # the processor registers the recompiled file again
+                self.processor(path)
+            except Exception as exc:
+                logger.error("Unable to recompile {}: {}".format(path, exc))
+                self.register(path, dependencies)
+            else:
+                logger.debug("Recompiled {}".format(path))
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("SASS watcher failed")
+
+    def stop(self):
+        self._stopped.set()
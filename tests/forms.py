@@ -0,0 +1,10 @@
+from django import forms
+
+from sass_processor.processor import sass_processor
+
+
+class BlueboxForm(forms.Form):
+    class Media:
+        css = {
+            'all': [sass_processor('tests/css/bluebox.scss')],
+        }
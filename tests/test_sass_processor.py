@@ -1,7 +1,16 @@
 import calendar
+import json
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
 from django.conf import settings
 from django.core.management import call_command
@@ -11,6 +20,13 @@ from django.test import TestCase, override_settings
 
 class SassProcessorTest(TestCase):
 
+    def touch(self, filename):
+        """Set the mtime of a file into the future, and restore it after the test"""
+        stat = os.stat(filename)
+        self.addCleanup(os.utime, filename, (stat.st_atime, stat.st_mtime))
+        now = time.time() + 10
+        os.utime(filename, (now, now))
+
     def setUp(self):
         super(SassProcessorTest, self).setUp()
         try:
@@ -19,7 +35,10 @@ class SassProcessorTest(TestCase):
             pass
 
     def tearDown(self):
+        from sass_processor.processor import SassProcessor
+
         shutil.rmtree(settings.STATIC_ROOT)
+        SassProcessor.clear_cache()
 
     def assert_sass_src_engine(self, template_name, engine):
         template = get_template(
@@ -83,6 +102,56 @@ class SassProcessorTest(TestCase):
         expected = '.bluebox{background-color:#0000ff;margin:10.0px 5.0px 20.0px 15.0px;color:#fa0a78}\n\n/*# sourceMappingURL=bluebox.css.map */'
         self.assertEqual(expected, output)
 
+    def test_freshness_cache(self):
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        css_file = os.path.join(settings.STATIC_ROOT, 'tests/css/bluebox.css')
+        with mock.patch.object(SassProcessor, 'cache_timeout', None):
+            sass_processor('tests/css/bluebox.scss')
+            os.remove(css_file + '.map')
+            # a hot render is answered by the cache, hence the missing sourcemap is not noticed
+            self.assertEqual('/static/tests/css/bluebox.css', sass_processor('tests/css/bluebox.scss'))
+            self.assertFalse(os.path.exists(css_file + '.map'))
+
+        # with a short timeout, entries are revalidated against the mtimes of their dependencies
+        scss_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/bluebox.scss')
+        with mock.patch.object(SassProcessor, 'cache_timeout', 1e-9):
+            self.touch(scss_file)
+            sass_processor('tests/css/bluebox.scss')
+            self.assertTrue(os.path.exists(css_file + '.map'))
+
+    def test_dependency_index(self):
+        from sass_processor.dependencies import DependencyIndex
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        index_file = os.path.join(settings.STATIC_ROOT, 'dependencies.json')
+        css_file = os.path.join(settings.STATIC_ROOT, 'tests/css/main.css')
+        scss_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.scss')
+        partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+        with mock.patch.object(SassProcessor, 'dependency_index', DependencyIndex(index_file)):
+            sass_processor('tests/css/main.scss')
+            entry = DependencyIndex(index_file).get(scss_file)
+            self.assertEqual('tests/css/main.css', entry['css'])
+            self.assertEqual({scss_file, partial_file}, set(entry['sources']))
+
+            # freshness is determined by the index, without reading the sourcemap
+            timestamp = os.path.getmtime(css_file)
+            os.remove(css_file + '.map')
+            sass_processor('tests/css/main.scss')
+            self.assertEqual(timestamp, os.path.getmtime(css_file))
+
+            # touching a partial triggers a recompilation
+            self.touch(partial_file)
+            sass_processor('tests/css/main.scss')
+            self.assertTrue(os.path.exists(css_file + '.map'))
+
+        # a fresh process with a fresh index notices, that the compiled file has been removed
+        SassProcessor.clear_cache()
+        os.remove(css_file)
+        with mock.patch.object(SassProcessor, 'dependency_index', DependencyIndex(index_file)):
+            sass_processor('tests/css/main.scss')
+        self.assertTrue(os.path.exists(css_file))
+
     def assert_management_command(self, **kwargs):
         call_command(
             'compilescss',
@@ -140,3 +209,712 @@ class SassProcessorTest(TestCase):
             engine=['jinja2', 'django'],
             use_storage=True
         )
+
+    @override_settings(DEBUG=False)
+    def test_management_command_jobs(self):
+        call_command('compilescss', jobs=2)
+        css_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')
+        with open(css_file, 'r') as f:
+            output = f.read()
+        expected = '#main p{color:#00ff00;width:97%}#main p .redbox{background-color:#ff0000}#main p .redbox:hover{color:#000000}\n'
+        self.assertEqual(expected, output)
+        css_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/bluebox.css')
+        with open(css_file, 'r') as f:
+            output = f.read()
+        expected = '.bluebox{background-color:#0000ff;margin:10.0px 5.0px 20.0px 15.0px;color:#fa0a78}\n'
+        self.assertEqual(expected, output)
+
+        call_command('compilescss', delete_files=True)
+        self.assertFalse(os.path.exists(css_file))
+
+    def test_management_command_compile_error(self):
+        from django.core.management.base import CommandError
+        from sass_processor.management.commands.compilescss import Command
+
+        broken_file = os.path.join(tempfile.mkdtemp(), 'broken.scss')
+        self.addCleanup(shutil.rmtree, os.path.dirname(broken_file))
+        with open(broken_file, 'w') as f:
+            f.write('.broken { color: ')
+        get_compile_kwargs = Command.get_compile_kwargs
+
+        def compile_broken_bluebox(command, sass_filename):
+            compile_kwargs = get_compile_kwargs(command, sass_filename)
+            if sass_filename.endswith('bluebox.scss'):
+                compile_kwargs['filename'] = broken_file
+            return compile_kwargs
+
+        main_css = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        # errors are reported the same way, whether files are compiled sequentially or in parallel
+        for jobs in (1, 2):
+            stderr = StringIO()
+            with mock.patch.object(Command, 'get_compile_kwargs', compile_broken_bluebox):
+                with self.assertRaisesMessage(CommandError, "1 SASS/SCSS files failed to compile."):
+                    call_command('compilescss', jobs=jobs, verbosity=0, stderr=stderr)
+            self.assertIn("Unable to compile {}".format(
+                os.path.join(settings.PROJECT_ROOT, 'static/tests/css/bluebox.scss')), stderr.getvalue())
+            self.assertTrue(os.path.exists(main_css))
+            os.remove(main_css)
+
+    @override_settings(DEBUG=False)
+    def test_management_command_incremental(self):
+        from sass_processor.dependencies import file_digest
+        from sass_processor.utils import write_json
+
+        cache_dir = os.path.join(settings.STATIC_ROOT, 'cache')
+        main_css = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')
+        bluebox_css = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/bluebox.css')
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+
+        # the fingerprints are written once, and each dependency is hashed once
+        with mock.patch('sass_processor.dependencies.write_json', wraps=write_json) as mocked_write_json, \
+                mock.patch('sass_processor.dependencies.file_digest', wraps=file_digest) as mocked_file_digest:
+            call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+        self.assertTrue(os.path.exists(main_css))
+        self.assertTrue(os.path.exists(bluebox_css))
+        self.assertEqual(1, mocked_write_json.call_count)
+        hashed_files = [call.args[0] for call in mocked_file_digest.call_args_list]
+        self.assertEqual(sorted(set(hashed_files)), sorted(hashed_files))
+
+        stdout = StringIO()
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, stdout=stdout)
+        self.assertIn("Successfully compiled 0 referred SASS/SCSS files.", stdout.getvalue())
+        self.assertIn("Skipped 2 unchanged SASS/SCSS files.", stdout.getvalue())
+
+        # modifying the content of a partial, only recompiles the files importing it
+        partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+        with open(partial_file, 'rb') as f:
+            content = f.read()
+        self.addCleanup(Path(partial_file).write_bytes, content)
+        with open(partial_file, 'ab') as f:
+            f.write(b'.greenbox { color: #00ff00; }\n')
+        stdout = StringIO()
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, stdout=stdout)
+        self.assertIn("Successfully compiled 1 referred SASS/SCSS files.", stdout.getvalue())
+        with open(main_css, 'r') as f:
+            self.assertIn('.greenbox', f.read())
+
+        # a missing output file is recompiled
+        os.remove(bluebox_css)
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+        self.assertTrue(os.path.exists(bluebox_css))
+
+    @override_settings(DEBUG=False)
+    def test_management_command_incremental_postprocessors(self):
+        def postprocessor(items):
+            return [content + b'/* postprocessed */\n' for _, content in items]
+
+        cache_dir = os.path.join(settings.STATIC_ROOT, 'cache')
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+
+        # changing the postprocessors recompiles all files
+        stdout = StringIO()
+        with override_settings(SASS_PROCESSOR_POSTPROCESSORS=[postprocessor]):
+            call_command('compilescss', incremental=True, cache_dir=cache_dir, stdout=stdout)
+        self.assertIn("Successfully compiled 2 referred SASS/SCSS files.", stdout.getvalue())
+        main_css = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')
+        with open(main_css, 'r') as f:
+            self.assertIn('/* postprocessed */', f.read())
+
+        stdout = StringIO()
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, stdout=stdout)
+        self.assertIn("Successfully compiled 2 referred SASS/SCSS files.", stdout.getvalue())
+
+    @override_settings(DEBUG=False)
+    def test_management_command_scan_cache(self):
+        from sass_processor.management.commands.compilescss import Command
+
+        cache_dir = os.path.join(settings.STATIC_ROOT, 'cache')
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+        with open(os.path.join(cache_dir, 'scan-django.json'), 'r') as f:
+            scan_cache = json.load(f)
+        forms_file = os.path.join(settings.PROJECT_ROOT, 'forms.py')
+        self.assertEqual(['tests/css/bluebox.scss'], scan_cache[forms_file]['references'])
+
+        # unchanged files are not parsed again
+        with mock.patch.object(Command, 'find_source_references') as find_source_references, \
+                mock.patch.object(Command, 'find_template_references') as find_template_references:
+            call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+        find_source_references.assert_not_called()
+        find_template_references.assert_not_called()
+
+    def test_management_command_prefilter(self):
+        from sass_processor.management.commands.compilescss import Command, SASS_SRC_TAG, file_contains
+
+        template_file = os.path.join(settings.PROJECT_ROOT, 'templates/tests/django.html')
+        self.assertTrue(file_contains(template_file, SASS_SRC_TAG))
+        self.assertFalse(file_contains(os.path.join(settings.PROJECT_ROOT, '__init__.py'), SASS_SRC_TAG))
+
+        # Python files which do not invoke `sass_processor` are not parsed at all
+        command = Command()
+        with mock.patch('ast.parse') as parse:
+            references = command.find_source_references(os.path.join(settings.PROJECT_ROOT, '__init__.py'))
+        self.assertEqual([], references)
+        parse.assert_not_called()
+        references = command.find_source_references(os.path.join(settings.PROJECT_ROOT, 'forms.py'))
+        self.assertEqual(['tests/css/bluebox.scss'], references)
+
+    def test_management_command_parallel_scan(self):
+        from concurrent.futures import ProcessPoolExecutor
+        from sass_processor.management.commands.compilescss import SASS_PROCESSOR_CALL, Command, file_contains
+
+        command = Command()
+        command.parser = command.get_parser('django')
+        command.verbosity = 0
+        sources = list(command.find_sources())
+        templates = sorted(command.find_templates())
+        expected = list(command.scan_files(sources, 'source')), list(command.scan_files(templates, 'template'))
+        command.jobs = 2
+        with mock.patch.object(ProcessPoolExecutor, 'map', autospec=True,
+                               side_effect=ProcessPoolExecutor.map) as pool_map:
+            scanned = list(command.scan_files(sources, 'source')), list(command.scan_files(templates, 'template'))
+        self.assertEqual(expected, scanned)
+        self.assertIn((os.path.join(settings.PROJECT_ROOT, 'forms.py'), ['tests/css/bluebox.scss']), scanned[0])
+        # Python files which can not invoke `sass_processor` are not sent to the pool
+        submitted = list(pool_map.call_args_list[0].args[3])
+        self.assertLess(len(submitted), len(sources))
+        self.assertTrue(all(file_contains(filename, SASS_PROCESSOR_CALL) for filename in submitted))
+
+    def test_management_command_list_references(self):
+        stdout = StringIO()
+        call_command('compilescss', list_references=True, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        bluebox_scss = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/bluebox.scss')
+        main_scss = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.scss')
+        bluebox_index = lines.index("tests/css/bluebox.scss ({})".format(bluebox_scss))
+        main_index = lines.index("tests/css/main.scss ({})".format(main_scss))
+        self.assertIn("    {}".format(os.path.join(settings.PROJECT_ROOT, 'forms.py')), lines[bluebox_index:main_index])
+        self.assertIn("    {}".format(os.path.join(settings.PROJECT_ROOT, 'templates/tests/django.html')),
+                      lines[main_index:])
+        self.assertFalse(os.path.exists(os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')))
+
+    @skipUnless(shutil.which('node'), "node is not installed")
+    def test_postcss_worker(self):
+        from sass_processor.postcss import PostcssError, PostcssWorker
+
+        # use stubs for postcss and autoprefixer, in order not to depend on node modules being installed
+        node_modules_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, node_modules_dir)
+        os.mkdir(os.path.join(node_modules_dir, 'postcss'))
+        with open(os.path.join(node_modules_dir, 'postcss', 'index.js'), 'w') as f:
+            f.write("module.exports = plugins => ({process: (css, opts) => {\n"
+                    "  if (css.includes('error')) throw new Error('CssSyntaxError');\n"
+                    "  if (css.includes('hang')) return new Promise(() => {});\n"
+                    "  return Promise.resolve({css: plugins.reduce((css, plugin) => plugin(css), css)});\n"
+                    "}});\n")
+        os.mkdir(os.path.join(node_modules_dir, 'autoprefixer'))
+        with open(os.path.join(node_modules_dir, 'autoprefixer', 'index.js'), 'w') as f:
+            f.write("module.exports = css => css.replace('display:flex', 'display:-webkit-box;display:flex');\n")
+
+        worker = PostcssWorker(shutil.which('node'), node_modules_dir)
+        self.addCleanup(worker.stop)
+        self.assertEqual(b'.a{display:-webkit-box;display:flex}', worker.process(b'.a{display:flex}'))
+        pid = worker._proc.pid
+        self.assertEqual(b'.b{color:red}', worker.process(b'.b{color:red}'))
+        self.assertEqual(pid, worker._proc.pid)
+        with self.assertRaises(PostcssError):
+            worker.process(b'.error{}')
+        results = worker.process_batch([('a.css', b'.a{display:flex}'), ('error.css', b'.error{}')])
+        self.assertEqual((b'.a{display:-webkit-box;display:flex}', None), results[0])
+        self.assertIsNone(results[1][0])
+        self.assertIn('CssSyntaxError', results[1][1])
+
+        # a terminated worker is restarted on next use
+        worker._proc.kill()
+        worker._proc.wait()
+        self.assertEqual(b'.a{display:-webkit-box;display:flex}', worker.process(b'.a{display:flex}'))
+        self.assertNotEqual(pid, worker._proc.pid)
+
+        # a worker not responding in time is killed and restarted on next use
+        pid = worker._proc.pid
+        with mock.patch.object(worker, 'timeout', 0.5), self.assertRaises(PostcssError):
+            worker.process(b'.hang{}')
+        self.assertIsNone(worker._proc)
+        self.assertEqual(b'.a{display:-webkit-box;display:flex}', worker.process(b'.a{display:flex}'))
+        self.assertNotEqual(pid, worker._proc.pid)
+
+    def test_node_path(self):
+        from sass_processor.postcss import get_node_path
+
+        with override_settings(NODE_NPX_PATH='/opt/node/bin/npx'):
+            self.assertEqual('/opt/node/bin/node', get_node_path())
+            with override_settings(NODE_EXECUTABLE_PATH='/usr/local/bin/node'):
+                self.assertEqual('/usr/local/bin/node', get_node_path())
+        with override_settings(NODE_NPX_PATH='npx'):
+            self.assertEqual('node', get_node_path())
+
+    @override_settings(DEBUG=False)
+    def test_management_command_postprocess(self):
+        batches = []
+
+        def postprocessor(items):
+            batches.append([filename for filename, _ in items])
+            return [content + b'/* postprocessed */' for _, content in items]
+
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        with mock.patch('sass_processor.utils.get_postprocessors', return_value=[postprocessor]):
+            call_command('compilescss', jobs=2, verbosity=0)
+        # all compiled files are postprocessed in one batch
+        self.assertEqual(1, len(batches))
+        self.assertEqual(2, len(batches[0]))
+        css_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.css')
+        with open(css_file, 'r') as f:
+            self.assertTrue(f.read().endswith('/* postprocessed */'))
+
+    def test_compile_lock(self):
+        import sass
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        compile = sass.compile
+
+        def slow_compile(**kwargs):
+            time.sleep(0.1)
+            return compile(**kwargs)
+
+        lock_dir = os.path.join(settings.STATIC_ROOT, 'locks')
+        with mock.patch.object(SassProcessor, 'lock_dir', lock_dir), \
+                mock.patch.object(sass, 'compile', side_effect=slow_compile) as sass_compile:
+            threads = [threading.Thread(target=sass_processor, args=('tests/css/main.scss',)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # concurrent requests for the same file compile it only once
+        self.assertEqual(1, sass_compile.call_count)
+        self.assertTrue(os.path.exists(os.path.join(settings.STATIC_ROOT, 'tests/css/main.css')))
+
+    def test_save_file(self):
+        from django.core.files.storage import FileSystemStorage
+        from sass_processor.storage import save_file
+
+        storage = FileSystemStorage(location=settings.STATIC_ROOT)
+        self.assertEqual('tests/css/atomic.css', save_file(storage, 'tests/css/atomic.css', b'.a{}'))
+        with mock.patch.object(FileSystemStorage, 'delete') as delete:
+            save_file(storage, 'tests/css/atomic.css', b'.b{}')
+        # existing files are replaced atomically, rather than being deleted and saved again
+        delete.assert_not_called()
+        with open(os.path.join(settings.STATIC_ROOT, 'tests/css/atomic.css'), 'rb') as f:
+            self.assertEqual(b'.b{}', f.read())
+        self.assertEqual(['atomic.css'], os.listdir(os.path.join(settings.STATIC_ROOT, 'tests/css')))
+
+        # storages overwriting files by themselves, are not asked whether the file exists
+        remote_storage = mock.Mock(file_overwrite=True)
+        save_file(remote_storage, 'tests/css/atomic.css', b'.c{}')
+        remote_storage.exists.assert_not_called()
+        remote_storage.delete.assert_not_called()
+        remote_storage.save.assert_called_once()
+
+    def test_skip_unchanged_output(self):
+        from sass_processor.dependencies import DependencyIndex
+        from sass_processor.processor import SassProcessor, sass_processor
+        from sass_processor.storage import save_file
+
+        index_file = os.path.join(settings.STATIC_ROOT, 'dependencies.json')
+        partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+        with mock.patch.object(SassProcessor, 'dependency_index', DependencyIndex(index_file)):
+            sass_processor('tests/css/main.scss')
+            self.touch(partial_file)
+            with mock.patch('sass_processor.processor.save_file', wraps=save_file) as mocked_save_file:
+                sass_processor('tests/css/main.scss')
+            # the file has been recompiled, but neither the CSS nor the sourcemap have been written
+            mocked_save_file.assert_not_called()
+            entry = DependencyIndex(index_file).get(os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.scss'))
+            self.assertEqual(os.path.getmtime(partial_file), entry['sources'][partial_file][0])
+
+        # without dependency index, the sourcemap must be rewritten, since it determines freshness
+        self.touch(partial_file)
+        with mock.patch('sass_processor.processor.save_file', wraps=save_file) as mocked_save_file:
+            sass_processor('tests/css/main.scss')
+        self.assertEqual(['tests/css/main.css.map'], [c.args[1] for c in mocked_save_file.call_args_list])
+
+    def test_rewrite_overwritten_output(self):
+        from sass_processor.processor import sass_processor
+
+        css_file = os.path.join(settings.STATIC_ROOT, 'tests/css/main.css')
+        sass_processor('tests/css/main.scss')
+        with open(css_file, 'r') as fp:
+            expected = fp.read()
+
+        # another writer replaced the CSS file, while the sourcemap is missing
+        with open(css_file, 'w') as fp:
+            fp.write('.stale { color: red; }')
+        os.remove(css_file + '.map')
+        sass_processor('tests/css/main.scss')
+        with open(css_file, 'r') as fp:
+            self.assertEqual(expected, fp.read())
+
+    def test_content_hashing(self):
+        from sass_processor.dependencies import DependencyIndex, file_digest
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        index_file = os.path.join(settings.STATIC_ROOT, 'dependencies.json')
+        partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+        with mock.patch.object(SassProcessor, 'dependency_index', DependencyIndex(index_file, use_hashes=True)):
+            sass_processor('tests/css/main.scss')
+
+            # a dependency with a new mtime, but unchanged content does not trigger a recompilation
+            self.touch(partial_file)
+            with mock.patch('sass.compile') as sass_compile, \
+                    mock.patch('sass_processor.dependencies.file_digest', wraps=file_digest) as mocked_file_digest:
+                sass_processor('tests/css/main.scss')
+                sass_processor('tests/css/main.scss')
+            sass_compile.assert_not_called()
+            # and it is hashed only once
+            self.assertEqual([mock.call(partial_file)], mocked_file_digest.call_args_list)
+
+            # a dependency with changed content triggers a recompilation
+            with open(partial_file, 'rb') as f:
+                content = f.read()
+            self.addCleanup(Path(partial_file).write_bytes, content)
+            with open(partial_file, 'ab') as f:
+                f.write(b'.greenbox { color: #00ff00; }\n')
+            sass_processor('tests/css/main.scss')
+            with open(os.path.join(settings.STATIC_ROOT, 'tests/css/main.css'), 'r') as f:
+                self.assertIn('.greenbox', f.read())
+
+    def test_find_file_cache(self):
+        from django.contrib.staticfiles.finders import FileSystemFinder
+        from sass_processor.storage import clear_find_file_cache, find_file
+
+        scss_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/main.scss')
+        with override_settings(SASS_PROCESSOR_FINDER_CACHE_SIZE=16):
+            with mock.patch.object(FileSystemFinder, 'find', wraps=FileSystemFinder().find) as find:
+                self.assertEqual(scss_file, find_file('tests/css/main.scss'))
+                self.assertEqual(scss_file, find_file('tests/css/main.scss'))
+                self.assertEqual(1, find.call_count)
+                clear_find_file_cache()
+                find_file('tests/css/main.scss')
+                self.assertEqual(2, find.call_count)
+
+        with override_settings(DEBUG=True):
+            with mock.patch.object(FileSystemFinder, 'find', wraps=FileSystemFinder().find) as find:
+                find_file('tests/css/main.scss')
+                find_file('tests/css/main.scss')
+                self.assertEqual(2, find.call_count)
+
+    @override_settings(DEBUG=True)
+    def test_management_command_find_file_once(self):
+        from sass_processor.storage import find_file
+
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        with mock.patch('sass_processor.management.commands.compilescss.find_file', wraps=find_file) as find:
+            call_command('compilescss', verbosity=0)
+        paths = [call.args[0] for call in find.call_args_list]
+        self.assertIn('tests/css/main.scss', paths)
+        self.assertEqual(len(set(paths)), len(paths))
+
+    def test_url_cache(self):
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        with mock.patch.object(SassProcessor.source_storage.__class__, 'url',
+                               autospec=True, side_effect=lambda storage, name: '/static/' + name) as url:
+            self.assertEqual('/static/tests/css/bluebox.css', sass_processor('tests/css/bluebox.scss'))
+            self.assertEqual('/static/tests/css/bluebox.css', sass_processor('tests/css/bluebox.scss'))
+            self.assertEqual(1, url.call_count)
+
+        SassProcessor.clear_cache()
+        with mock.patch.object(SassProcessor, 'cache_busting', True):
+            url = sass_processor('tests/css/bluebox.scss')
+            self.assertRegex(url, r'^/static/tests/css/bluebox.css\?v=[0-9a-f]{12}$')
+            # the query string changes with the content of the compiled file
+            with open(os.path.join(settings.STATIC_ROOT, 'tests/css/bluebox.css'), 'ab') as f:
+                f.write(b'.redbox{}')
+            SassProcessor.clear_cache()
+            self.assertNotEqual(url, sass_processor('tests/css/bluebox.scss'))
+            url = sass_processor('tests/css/bluebox.scss')
+
+            # a file rewritten by another process is noticed while checking its freshness
+            css_file = os.path.join(settings.STATIC_ROOT, 'tests/css/bluebox.css')
+            with open(css_file, 'ab') as f:
+                f.write(b'.greenbox{}')
+            os.utime(css_file, (time.time() + 10, time.time() + 10))
+            self.assertNotEqual(url, sass_processor('tests/css/bluebox.scss'))
+
+    def test_sass_src_constant(self):
+        from sass_processor.processor import SassProcessor
+
+        template = get_template(template_name='tests/django.html', using='django')
+        # the loaded template keeps its resolved URL, hence evict it from the cached loader
+        self.addCleanup(lambda: [loader.reset() for loader in template.template.engine.template_loaders])
+        with mock.patch.object(SassProcessor, 'processor_enabled', False), \
+                mock.patch.object(SassProcessor, '__call__', autospec=True, return_value='tests/css/main.css') as call:
+            self.assertEqual('/static/tests/css/main.css', template.render({}).strip())
+            self.assertEqual('/static/tests/css/main.css', template.render({}).strip())
+        # a constant path is resolved only once, if freshness needs not to be checked
+        self.assertEqual(1, call.call_count)
+
+    def test_sass_src_jinja2_constant(self):
+        from sass_processor.processor import SassProcessor
+        from tests.jinja2 import environment
+
+        env = environment()
+        with mock.patch.object(SassProcessor, 'processor_enabled', False), \
+                mock.patch.object(SassProcessor, '__call__', autospec=True, return_value='tests/css/main.css') as call:
+            first = env.from_string("{% sass_src 'tests/css/main.scss' %}")
+            second = env.from_string("{% sass_src 'tests/css/main.scss' %}")
+            variable = env.from_string("{% sass_src source %}")
+            self.assertEqual(1, call.call_count)
+            self.assertEqual('/static/tests/css/main.css', first.render())
+            self.assertEqual('/static/tests/css/main.css', second.render())
+            self.assertEqual(1, call.call_count)
+            self.assertEqual('/static/tests/css/main.css', variable.render(source='tests/css/main.scss'))
+            self.assertEqual(2, call.call_count)
+
+        # with a bytecode cache, the URL must not be part of the compiled template
+        from jinja2 import FileSystemBytecodeCache
+
+        bytecode_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bytecode_dir)
+        env = environment(bytecode_cache=FileSystemBytecodeCache(bytecode_dir))
+        with mock.patch.object(SassProcessor, 'processor_enabled', False), \
+                mock.patch.object(SassProcessor, '__call__', autospec=True, return_value='tests/css/main.css') as call:
+            template = env.from_string("{% sass_src 'tests/css/main.scss' %}")
+            self.assertEqual(0, call.call_count)
+            self.assertEqual('/static/tests/css/main.css', template.render())
+            self.assertEqual(1, call.call_count)
+
+    def test_manifest(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from sass_processor.manifest import SassManifest
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        manifest = SassManifest(os.path.join(settings.STATIC_ROOT, 'manifest.json'))
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        with mock.patch.object(SassProcessor, 'manifest', manifest):
+            call_command('compilescss', verbosity=0)
+        with open(manifest.path, 'r') as f:
+            entries = json.load(f)
+        self.assertEqual({'tests/css/main.scss', 'tests/css/bluebox.scss'}, set(entries))
+        self.assertEqual('tests/css/main.css', entries['tests/css/main.scss']['css'])
+        self.assertEqual(32, len(entries['tests/css/main.scss']['hash']))
+
+        # with the processor disabled, files are resolved from the manifest without any file access,
+        # and their URLs are resolved only once
+        manifest = SassManifest(manifest.path)
+        with mock.patch.object(SassProcessor, 'manifest', manifest), \
+                mock.patch.object(SassProcessor, 'processor_enabled', False), \
+                mock.patch('sass_processor.processor.find_file', side_effect=AssertionError), \
+                mock.patch.object(SassProcessor, 'get_url', return_value='/static/tests/css/main.css') as get_url:
+            self.assertEqual('/static/tests/css/main.css', sass_processor('tests/css/main.scss'))
+            self.assertEqual('/static/tests/css/main.css', sass_processor('tests/css/main.scss'))
+            self.assertEqual(1, get_url.call_count)
+            with self.assertRaises(ImproperlyConfigured):
+                sass_processor('tests/css/missing.scss')
+
+    @override_settings(DEBUG=False)
+    def test_manifest_hashing_storage(self):
+        from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+        from sass_processor.manifest import SassManifest
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        manifest = SassManifest(os.path.join(settings.STATIC_ROOT, 'manifest.json'))
+        storage = ManifestStaticFilesStorage(location=settings.STATIC_ROOT, base_url=settings.STATIC_URL)
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        with mock.patch.object(SassProcessor, 'manifest', manifest), \
+                mock.patch.object(SassProcessor, 'source_storage', storage):
+            # static files have not been collected yet, hence their hashed names are unknown
+            call_command('compilescss', verbosity=0)
+
+        # simulate `collectstatic`, which writes the manifest of the static files storage
+        with open(os.path.join(settings.STATIC_ROOT, 'staticfiles.json'), 'w') as f:
+            json.dump({'version': '1.1', 'paths': {'tests/css/main.css': 'tests/css/main.0123456789ab.css'}}, f)
+        storage = ManifestStaticFilesStorage(location=settings.STATIC_ROOT, base_url=settings.STATIC_URL)
+        with mock.patch.object(SassProcessor, 'manifest', SassManifest(manifest.path)), \
+                mock.patch.object(SassProcessor, 'source_storage', storage), \
+                mock.patch.object(SassProcessor, 'processor_enabled', False):
+            self.assertEqual('/static/tests/css/main.0123456789ab.css', sass_processor('tests/css/main.scss'))
+
+    @override_settings(CACHES={'sass': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_output_cache(self):
+        import sass
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        main_css = os.path.join(settings.STATIC_ROOT, 'tests/css/main.css')
+        with mock.patch.object(SassProcessor, 'output_cache', 'sass'):
+            sass_processor('tests/css/main.scss')
+            with open(main_css, 'rb') as f:
+                content = f.read()
+
+            # another node, not sharing the storage, takes the compiled file from the cache
+            shutil.rmtree(os.path.join(settings.STATIC_ROOT, 'tests'))
+            SassProcessor.clear_cache()
+            with mock.patch.object(sass, 'compile', side_effect=AssertionError):
+                sass_processor('tests/css/main.scss')
+            with open(main_css, 'rb') as f:
+                self.assertEqual(content, f.read())
+            self.assertTrue(os.path.exists(main_css + '.map'))
+
+            # changing the content of a dependency requires to compile again
+            partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+            self.addCleanup(Path(partial_file).write_bytes, Path(partial_file).read_bytes())
+            with open(partial_file, 'ab') as f:
+                f.write(b'.greenbox { color: #00ff00; }\n')
+            shutil.rmtree(os.path.join(settings.STATIC_ROOT, 'tests'))
+            SassProcessor.clear_cache()
+            with mock.patch.object(sass, 'compile', wraps=sass.compile) as compile:
+                sass_processor('tests/css/main.scss')
+            self.assertEqual(1, compile.call_count)
+            with open(main_css, 'r') as f:
+                self.assertIn('.greenbox', f.read())
+
+    def test_watcher_start(self):
+        from django.apps import apps
+        from sass_processor.processor import SassProcessor, sass_processor
+
+        with mock.patch.object(SassProcessor, 'watch', True), \
+                mock.patch.object(SassProcessor, 'watcher', None):
+            # starting Django, for instance to run a management command, does not start the watcher
+            apps.get_app_config('sass_processor').ready()
+            self.assertIsNone(SassProcessor.watcher)
+
+            sass_processor('tests/css/main.scss')
+            watcher = SassProcessor.watcher
+            self.addCleanup(watcher.join)
+            self.addCleanup(watcher.stop)
+            self.assertTrue(watcher.is_alive())
+            sass_processor('tests/css/bluebox.scss')
+            self.assertIs(watcher, SassProcessor.watcher)
+
+    def test_watcher(self):
+        import sass
+        from sass_processor.processor import SassProcessor, sass_processor
+        from sass_processor.watcher import SassWatcher
+
+        watcher = SassWatcher(SassProcessor())
+        partial_file = os.path.join(settings.PROJECT_ROOT, 'static/tests/css/_redbox.scss')
+        with mock.patch.object(SassProcessor, 'watcher', watcher):
+            sass_processor('tests/css/main.scss')
+            sass_processor('tests/css/bluebox.scss')
+            self.assertEqual({'tests/css/main.scss'}, watcher.get_dependents()[partial_file])
+            # each dependency is checked once
+            with mock.patch('os.stat', wraps=os.stat) as mocked_stat:
+                self.assertEqual([], watcher.poll())
+            self.assertEqual(sorted(watcher.get_dependents()), sorted(c.args[0] for c in mocked_stat.call_args_list))
+
+            # modifying a partial recompiles only the files depending on it
+            self.touch(partial_file)
+            self.assertEqual(['tests/css/main.scss'], watcher.poll())
+            with mock.patch.object(sass, 'compile', wraps=sass.compile) as compile:
+                watcher.check()
+            self.assertEqual(1, compile.call_count)
+            self.assertEqual([], watcher.poll())
+
+    def test_management_command_changed(self):
+        from sass_processor.dependencies import DependencyIndex
+
+        cache_dir = os.path.join(settings.STATIC_ROOT, 'cache')
+        static_dir = os.path.join(settings.PROJECT_ROOT, 'static/tests/css')
+        partial_file = os.path.join(static_dir, '_redbox.scss')
+        self.addCleanup(call_command, 'compilescss', delete_files=True, verbosity=0)
+        call_command('compilescss', incremental=True, cache_dir=cache_dir, verbosity=0)
+
+        fingerprints = DependencyIndex(os.path.join(cache_dir, 'fingerprints.json'))
+        self.assertEqual([os.path.join(static_dir, 'main.scss')], fingerprints.get_dependents(partial_file))
+        self.assertEqual([os.path.join(static_dir, 'bluebox.scss')],
+                         fingerprints.get_dependents(os.path.join(static_dir, 'bluebox.scss')))
+        self.assertEqual([], fingerprints.get_dependents(os.path.join(static_dir, 'unknown.scss')))
+
+        # only the files depending on a changed file are recompiled
+        self.addCleanup(Path(partial_file).write_bytes, Path(partial_file).read_bytes())
+        with open(partial_file, 'ab') as f:
+            f.write(b'.greenbox { color: #00ff00; }\n')
+        stdout = StringIO()
+        call_command('compilescss', changed=[partial_file], cache_dir=cache_dir, stdout=stdout)
+        self.assertIn("Successfully compiled 1 referred SASS/SCSS files.", stdout.getvalue())
+        self.assertIn("Skipped 1 unchanged SASS/SCSS files.", stdout.getvalue())
+
+        # a removed destination file is recompiled, even if none of its dependencies changed
+        bluebox_css = os.path.join(static_dir, 'bluebox.css')
+        os.remove(bluebox_css)
+        call_command('compilescss', changed=[partial_file], cache_dir=cache_dir, verbosity=0)
+        self.assertTrue(os.path.exists(bluebox_css))
+
+        # as are all files, after the compiler options changed
+        stdout = StringIO()
+        call_command('compilescss', changed=[partial_file], cache_dir=cache_dir, sass_precision=3, stdout=stdout)
+        self.assertIn("Successfully compiled 2 referred SASS/SCSS files.", stdout.getvalue())
+
+    def test_apps_include_dirs(self):
+        from sass_processor.apps import SassProcessorConfig
+
+        static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_dir)
+        os.makedirs(os.path.join(static_dir, 'node_modules', 'pkg'))
+        Path(static_dir, 'node_modules', 'pkg', '_vendor.scss').touch()
+        self.assertFalse(SassProcessorConfig.traverse_tree(static_dir)['match'])
+        os.makedirs(os.path.join(static_dir, 'css'))
+        Path(static_dir, 'css', '_partial.scss').touch()
+        self.assertTrue(SassProcessorConfig.traverse_tree(static_dir)['match'])
+
+        # the outcome is cached, as long as none of the traversed folders changed
+        tests_static_dir = os.path.join(settings.PROJECT_ROOT, 'static')
+        cache_file = os.path.join(settings.STATIC_ROOT, 'include-dirs.json')
+        with mock.patch.object(SassProcessorConfig, '_cache_file', cache_file):
+            self.assertIn(tests_static_dir, SassProcessorConfig.find_include_dirs())
+            with mock.patch('os.walk', side_effect=AssertionError):
+                self.assertIn(tests_static_dir, SassProcessorConfig.find_include_dirs())
+
+    def test_import_footprint(self):
+        # serving precompiled CSS files must neither load libsass nor the compile machinery
+        script = '\n'.join([
+            "import sys",
+            "from django.conf import settings",
+            "settings.configure(INSTALLED_APPS=['django.contrib.staticfiles', 'sass_processor'],",
+            "                   STATIC_URL='/static/', SASS_PROCESSOR_ENABLED=False,",
+            "                   TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}])",
+            "import django",
+            "django.setup()",
+            "from django.template import engines",
+            "engines['django'].from_string(\"{% load sass_tags %}{% sass_src 'tests/css/main.scss' %}\")",
+            "import sass_processor.jinja2.ext",
+            "print(' '.join(sorted(name for name in sys.modules if name.split('.')[0] in ['sass', '_sass'])))",
+            "print(' '.join(sorted(name for name in sys.modules if name.startswith('sass_processor.'))))",
+        ])
+        output = subprocess.run(
+            [sys.executable, '-c', script], check=True, capture_output=True, text=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE=''),
+        ).stdout.split('\n')
+        self.assertEqual('', output[0])
+        self.assertNotIn('sass_processor.postcss', output[1].split())
+        self.assertNotIn('sass_processor.management.commands.compilescss', output[1].split())
+
+    def test_compile_profile(self):
+        from sass_processor.management.commands.compilescss import Command
+        from sass_processor.processor import SassProcessor
+        from sass_processor.profile import CompileProfile
+
+        profile = CompileProfile(['extra/', 'extra', os.path.abspath('extra')], precision=8)
+        self.assertEqual((os.path.abspath('extra'),), profile.include_paths)
+        self.assertIs(profile.custom_functions, profile.custom_functions)
+        self.assertIsInstance(profile.custom_functions, frozenset)
+        self.assertIs(profile.custom_functions, profile.replace(precision=5).custom_functions)
+        self.assertIs(profile.postprocessors, profile.replace(precision=5).postprocessors)
+        self.assertEqual(5, profile.replace(precision=5).get_compile_kwargs('main.scss')['precision'])
+
+        # the SASS processor and the management command compile with the same options
+        profile = SassProcessor.get_compile_profile()
+        self.assertIs(profile, SassProcessor.get_compile_profile())
+        command = Command()
+        command.profile = profile.replace(precision=SassProcessor.sass_precision)
+        compile_kwargs = command.get_compile_kwargs('main.scss')
+        self.assertTrue(compile_kwargs.pop('omit_source_map_url'))
+        self.assertEqual(profile.get_compile_kwargs('main.scss', custom_functions=False), compile_kwargs)
+
+        # looking up the include folders does not block freshness checks
+        def get_apps_include_dirs():
+            acquired = SassProcessor._freshness_lock.acquire(blocking=False)
+            if acquired:
+                SassProcessor._freshness_lock.release()
+            self.assertTrue(acquired)
+            return []
+
+        SassProcessor.reset_compile_profile()
+        with mock.patch('sass_processor.processor.get_apps_include_dirs', get_apps_include_dirs):
+            SassProcessor.get_compile_profile()
+        SassProcessor.reset_compile_profile()
+
+        # the profile is rebuilt after a reset
+        with override_settings(SASS_PROCESSOR_CUSTOM_FUNCTIONS={}):
+            self.assertIsNot(profile, SassProcessor.get_compile_profile())